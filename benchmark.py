@@ -0,0 +1,189 @@
+import sys, os, time, random, resource, argparse, json, csv, multiprocessing
+from datacenter import DataCenter
+from engine import EventEngine, ArrayEngine
+from throughput import EqualShare, MaxMinFair
+from topology import Topology
+from metrics import Metrics
+from test import fill_datacenter
+from greedy_test import GreedyServer
+from pairs_test import PairwiseServer
+from straggler_test import StragglerServer
+from real_test import SmartServer
+
+# Runs the placement schemes headless on the virtual clock, under fixed seeds,
+# and reports how well each one did and how fast the simulator ran:
+#
+#   python benchmark.py --schemes greedy,smart --seeds 1,2,3 --csv
+#
+# Every run happens in a fresh process, so that its peak memory is its own and
+# nothing (like SmartVM threads) is left over from the one before.
+
+SCHEMES = {
+    'greedy': GreedyServer,
+    'pairs': PairwiseServer,
+    'straggler': StragglerServer,
+    'smart': SmartServer,
+}
+
+ENGINES = {'EventEngine': EventEngine, 'ArrayEngine': ArrayEngine}
+MODELS = {'EqualShare': EqualShare, 'MaxMinFair': MaxMinFair}
+
+# Each scenario fills the data center with fill_users - 1 background users of
+# fill_vms VMs each, then starts users servers with vms VMs each. standard is
+# the benchmark the drivers run.
+SCENARIOS = {
+    'standard': dict(topology=Topology.quarter, fill_users=20, fill_vms=10,
+                     fill_data=10 ** 7, users=10, vms=20, max_data=100000),
+    'full': dict(topology=Topology.full, fill_users=80, fill_vms=10,
+                 fill_data=10 ** 7, users=40, vms=20, max_data=100000),
+    'pods': dict(topology=lambda: Topology.pods(16), fill_users=320,
+                 fill_vms=10, fill_data=10 ** 7, users=160, vms=20,
+                 max_data=100000),
+}
+
+# The columns of the CSV output, in order
+FIELDS = ['scheme', 'scenario', 'seed', 'engine', 'model', 'finished',
+          'makespan', 'mean_completion', 'core_traffic', 'events', 'wall',
+          'events_per_sec', 'peak_memory_kb', 'completion', 'vm_seconds']
+
+# Run one scheme on one scenario, and return a dict of results. The run stops
+# after limit seconds of simulated time even if some users haven't finished.
+# Any other keyword arguments override the scenario's settings, e.g. users=20
+# or max_data=10000. If metrics is set, the results also include the data
+# center's counters from the servers' part of the run (see metrics.py).
+def run(scheme, scenario='standard', seed=1, engine='EventEngine',
+        model='EqualShare', limit=10000, metrics=False, **overrides):
+    conf = dict(SCENARIOS[scenario])
+    for key in overrides:
+        if key not in conf:
+            raise Exception('Unknown scenario setting: ' + key)
+    conf.update(overrides)
+    random.seed(seed)
+
+    # the servers still print a little
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        dc = DataCenter(virtual=True, engine=ENGINES[engine],
+                        model=MODELS[model], topology=conf['topology']())
+        dc.renderer.enabled = False
+        fill_datacenter(dc, conf['fill_users'], conf['fill_vms'],
+                        conf['fill_data'])
+        dc.run_until(dc.now() + 1)
+
+        servers = [SCHEMES[scheme](i, conf['vms'], dc=dc,
+                                   max_data=conf['max_data'])
+                   for i in range(conf['users'])]
+
+        counters = Metrics(dc) if metrics else None
+        start = time.time()
+        events = dc.completed
+        dc.pause()
+        for s in servers:
+            s.start()
+        dc.unpause()
+
+        # step the servers once a second until they are all done
+        completion = {}
+        while len(completion) < len(servers) and dc.now() < limit:
+            for s in servers:
+                if not s.finished:
+                    s.loop()
+                if s.finished and s.user not in completion:
+                    completion[s.user] = dc.now()
+            dc.run_until(dc.now() + 1)
+
+        wall = time.time() - start
+        events = dc.completed - events
+        core = dc.core_traffic()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    times = completion.values()
+    result = {
+        'scheme': scheme,
+        'scenario': scenario,
+        'seed': seed,
+        'engine': engine,
+        'model': model,
+        'finished': len(completion) == len(servers),
+        'makespan': max(times) if times else None,
+        'mean_completion': sum(times) / len(times) if times else None,
+        'core_traffic': core,
+        'events': events,
+        'wall': wall,
+        'events_per_sec': events / wall if wall else None,
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'completion': [completion.get(s.user) for s in servers],
+        'vm_seconds': [dc.user_time(s.user) for s in servers],
+    }
+    if counters is not None:
+        counters.detach()
+        result['metrics'] = counters.as_dict()
+    return result
+
+# run() in a process of its own
+def run_isolated(*args):
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(run, args)
+    finally:
+        pool.terminate()
+
+# Write results out as CSV, with the per-user lists joined by spaces. Any
+# metrics are left out; they only go in the JSON.
+def write_csv(results, out):
+    writer = csv.DictWriter(out, FIELDS)
+    writer.writeheader()
+    for r in results:
+        row = dict(r)
+        row.pop('metrics', None)
+        for key in ('completion', 'vm_seconds'):
+            row[key] = ' '.join(str(x) for x in r[key])
+        writer.writerow(row)
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Compare placement schemes on the virtual clock.')
+    parser.add_argument('--schemes', default=','.join(sorted(SCHEMES)),
+                        help='comma-separated schemes to run')
+    parser.add_argument('--scenario', default='standard',
+                        choices=sorted(SCENARIOS))
+    parser.add_argument('--seeds', default='1',
+                        help='comma-separated random seeds')
+    parser.add_argument('--engine', default='EventEngine',
+                        choices=sorted(ENGINES))
+    parser.add_argument('--model', default='EqualShare',
+                        choices=sorted(MODELS))
+    parser.add_argument('--limit', type=float, default=10000,
+                        help='simulated seconds before a run is cut off')
+    parser.add_argument('--csv', action='store_true',
+                        help='write CSV instead of JSON')
+    parser.add_argument('--out', help='file to write to instead of stdout')
+    parser.add_argument('--metrics', action='store_true',
+                        help='count where the simulator spends its time')
+    args = parser.parse_args(argv)
+
+    results = []
+    for scheme in args.schemes.split(','):
+        if scheme not in SCHEMES:
+            parser.error('unknown scheme: ' + scheme)
+        for seed in args.seeds.split(','):
+            results.append(run_isolated(scheme, args.scenario, int(seed),
+                                        args.engine, args.model, args.limit,
+                                        args.metrics))
+            print >> sys.stderr, scheme, 'seed', seed, 'makespan', \
+                results[-1]['makespan'], 'wall %.2f' % results[-1]['wall']
+
+    out = open(args.out, 'w') if args.out else sys.stdout
+    if args.csv:
+        write_csv(results, out)
+    else:
+        json.dump(results, out, indent=2)
+        out.write('\n')
+    if args.out:
+        out.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
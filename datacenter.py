@@ -1,91 +1,450 @@
-import sys, math, random, time, itertools, threading
-from machine import Machine, VirtualMachine
+import sys, math, time, itertools, contextlib, functools
+import numpy as np
+from machine import Machine, VirtualMachine, FreeSlots, ip_to_handle
+from engine import EventEngine, ArrayEngine
+from throughput import EqualShare, MaxMinFair
+from topology import Topology
+from status import StatusRenderer, bcolors
+from rwlock import RWLock
+from metrics import timed
+from telemetry import Telemetry
+from events import *
 from collections import defaultdict
 
 # If true, print extra info
 VERBOSE = False
 
-# Helper class for text colors
-class bcolors:
-    HEADER = '\033[95m'
-    BLUE = '\033[94m'
-    GREEN = '\033[92m'
-    YELLOW = '\033[93m'
-    FAIL = '\033[91m'
-    ENDC = '\033[0m'
+# DataCenter methods which change it hold its lock for writing. Queries bring
+# it up to date first, which needs the write lock only briefly, and then look
+# at it holding the lock for reading, so they can run alongside each other.
+# If a Metrics is attached (see metrics.py), each call is timed as well.
+def _writer(method):
+    name = method.__name__
+
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        if self.metrics is not None:
+            return self._timed(name, locked_call, args, kwargs)
+        return locked_call(self, *args, **kwargs)
+
+    def locked_call(self, *args, **kwargs):
+        with self.lock.writing():
+            return method(self, *args, **kwargs)
+    return locked
+
+def _reader(method):
+    name = method.__name__
+
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        if self.metrics is not None:
+            return self._timed(name, locked_call, args, kwargs)
+        return locked_call(self, *args, **kwargs)
+
+    def locked_call(self, *args, **kwargs):
+        self._update()
+        with self.lock.reading():
+            return method(self, *args, **kwargs)
+    return locked
+
+
+# A read-only view of the VMs in a data center by ip address, so that
+# dc.VMs[ip] works as it always has. The VMs themselves are kept in a list
+# indexed by their integer handles.
+class VMView(object):
+    def __init__(self, dc):
+        self.dc = dc
+
+    def __len__(self):
+        return len(self.dc._vms) - len(self.dc._free_handles)
+
+    def __contains__(self, ip):
+        return self.get(ip) is not None
+
+    def __getitem__(self, ip):
+        v = self.get(ip)
+        if v is None:
+            raise KeyError(ip)
+        return v
+
+    def __iter__(self):
+        return (v.ip for v in self.itervalues())
+
+    def get(self, ip, default=None):
+        h = ip_to_handle(ip)
+        vms = self.dc._vms
+        if h is None or h >= len(vms) or vms[h] is None:
+            return default
+        return vms[h]
+
+    def itervalues(self):
+        return (v for v in self.dc._vms if v is not None)
+
+    def iteritems(self):
+        return ((v.ip, v) for v in self.itervalues())
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+
+# Running totals for one user, kept up to date as their VMs come and go and
+# their transfers move data, so that reading them never means looking at the
+# VMs. remaining is the data (in MB) the user's VMs in the network still have
+# to send, as of the last update, and done is what they have sent so far.
+# transfers counts the unfinished transfers behind remaining, and completed
+# is the time the last of them finished, or None while any are left.
+# VM-seconds are only added up when the number of VMs changes; seconds(t)
+# gives the total up to time t. members is the set of the user's VMs in the
+# network.
+class UserStats(object):
+    __slots__ = ('vms', 'members', 'transfers', 'remaining', 'done',
+                 'vm_seconds', 'stamp', 'completed')
+
+    def __init__(self):
+        self.vms = 0
+        self.members = set()
+        self.transfers = 0
+        self.remaining = 0.0
+        self.done = 0.0
+        self.vm_seconds = 0.0
+        self.stamp = 0.0
+        self.completed = None
+
+    # Add n VMs (or take them away, if n is negative) at time t
+    def add_vms(self, n, t):
+        self.vm_seconds = self.seconds(t)
+        self.stamp = t
+        self.vms += n
+
+    def seconds(self, t):
+        return self.vm_seconds + self.vms * (t - self.stamp)
+
 
 class DataCenter(object):
+    # The default layout. Each data center copies these from its topology.
     GROUP_SIZE = 12
     NUM_GROUPS = 24
     NUM_MACHINES = GROUP_SIZE * NUM_GROUPS
     AGG_ROUTERS = 4
     THROUGHPUT = 10000.0  # in MBPS
 
-    def __init__(self):
-        # machines stores Machine objects indexed by machine_id
-        self.machines = {i: Machine(i) for i in xrange(self.NUM_MACHINES)}
+    # If virtual is True, the data center runs on a simulated clock which
+    # only moves forward through run_until() and run_to_completion(), instead
+    # of following the wall clock. engine is the class which keeps track of
+    # active connections: EventEngine or ArrayEngine (see engine.py). model is
+    # the class which decides how fast they go: EqualShare or MaxMinFair (see
+    # throughput.py). topology is a Topology giving the size and shape of the
+    # data center (see topology.py); by default it is the usual 288 machines.
+    def __init__(self, virtual=False, engine=EventEngine, model=EqualShare,
+                 topology=None):
+        self.topology = topo = topology or Topology()
+        self.GROUP_SIZE = topo.machines_per_group
+        self.NUM_GROUPS = topo.num_groups
+        self.NUM_MACHINES = topo.num_machines
+        self.AGG_ROUTERS = topo.agg_routers
+        self.THROUGHPUT = topo.throughput
+
+        # machines stores Machine objects indexed by machine_id, and
+        # free_slots keeps track of which of them have room
+        self.free_slots = FreeSlots(self.NUM_MACHINES, self.GROUP_SIZE,
+                                    topo.slots_per_machine)
+        self.machines = {i: Machine(i, index=self.free_slots,
+                                    slots=topo.slots_per_machine)
+                         for i in xrange(self.NUM_MACHINES)}
 
         # groups stores collections of machines indexed by group id
-        self.groups = {i: [self.machines[j] for j in xrange(
-            i * self.GROUP_SIZE, (i + 1) * self.GROUP_SIZE)] 
-            for i in xrange(self.NUM_GROUPS)}
+        self.groups = {g: [self.machines[m] for m in topo.machines_in[g]]
+                       for g in xrange(self.NUM_GROUPS)}
 
-        # users keeps track of how much total time each user's VMs have used
-        self.users = defaultdict(lambda: [0, 0, 0])
+        # users keeps the running totals for each user; see user_stats()
+        self.users = defaultdict(UserStats)
 
         # Links are represented as tuples: (lower level, upper level)
-        # each link points to a list of the connections it currently serves.
+        # each link points to a set of the connection ids it currently serves.
         # For our purposes, the redundant routers are lumped into one.
-        self.agg_links = {link: set() for link in 
-                    [(i, int(i/6)) for i in range(self.NUM_GROUPS)]}
+        self.agg_links = {link: set() for link in topo.agg_link}
         self.core_links = {link: set() for link in range(self.AGG_ROUTERS)}
 
-        # stores VMs indexed by IP address
-        self.VMs = {}
+        # model works out the throughput between every pair of groups, and
+        # speeds is its table of them. _pairs maps each (group, group) pair to
+        # the ids of the connections between them.
+        self.model = model(self)
+        self.speeds = self.model.speeds
+        self._pairs = defaultdict(set)
+
+        # _vms stores the VMs in the network indexed by their handle, with
+        # None in the unused slots, whose handles are kept in _free_handles
+        # for reuse. VMs looks them up by ip address instead.
+        self._vms = []
+        self._free_handles = []
+        self.VMs = VMView(self)
+
+        # incoming maps each VM to the VMs in the network which still have
+        # data to send to it, whether or not it is in the network itself
+        self._incoming = defaultdict(set)
 
         # this is the last time the system was updated
-        self.time = time.time()
+        self.virtual = virtual
+        self.time = 0.0 if virtual else time.time()
         self.start_time = self.time
 
-        self.lock = threading.Lock()
+        # engine holds every active connection and predicts when each one
+        # will finish. Each VM's active_transfers holds the ids of its
+        # outgoing connections.
+        self.engine = engine()
+
+        # telemetry keeps a short history of the throughput of every
+        # connection and link, for tcp_throughput() and link_throughput()
+        self.telemetry = Telemetry(topo, self.time)
+
+        # running totals: how many transfers have finished, and how much
+        # data has been sent over the core, counting every connection across
+        # the core as sent in full until it is removed
+        self.completed = 0
+        self._core_sent = 0.0
+
+        # connections and links whose speed needs recalculating
+        self._changed = set()
+        self._touched_agg = set()
+        self._touched_core = set()
+
+        # see reading() for how threads share the data center
+        self.lock = RWLock()
         self.running = True
 
+        # how many batches we are inside of; see batch()
+        self._batching = 0
+
+        # draws the status to the terminal for draw_status()
+        self.renderer = StatusRenderer(self)
+
+        # if set, a TraceRecorder (tracelog.py) which records what happens
+        self.trace = None
+
+        # if set, a Metrics (metrics.py) which counts where the time goes
+        self.metrics = None
+
+        # events tells subscribers what happens (see events.py). The first
+        # subscriber passes finished transfers on to the VMs' own callbacks.
+        self.events = EventBus()
+        self.events.subscribe(TRANSFER_COMPLETE, notify_vm)
+
         print 'Data center initialized.'
     
     # Pause and play functions
+    @_writer
     def pause(self):
         self.running = False
 
+    @_writer
     def unpause(self):
         self.running = True
 
+    # Return the current system time, in seconds since the data center started
+    @_reader
+    def now(self):
+        return self.time - self.start_time
+
+    # Run the simulation up to t seconds after the data center started. On
+    # the virtual clock this jumps straight from one transfer completion to the
+    # next; on the wall clock it just waits until then.
+    def run_until(self, t):
+        target = self.start_time + t
+        if self.virtual:
+            with self.lock.writing():
+                self._advance(target)
+            return
+
+        delay = target - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self._update()
+
+    # Run the simulation until no more transfers are active, and return the
+    # time at which the last one finished
+    @_writer
+    def run_to_completion(self):
+        self._advance(self.time)
+        t = self.engine.next_time()
+        while t < float('inf'):
+            self.run_until(t - self.start_time)
+            t = self.engine.next_time()
+        return self.time - self.start_time
+
+    # Within a batch, placements and removals don't update the data center or
+    # recalculate link speeds; that happens once when the batch is over. The
+    # clock stands still in the meantime, so nothing ever sees a half-moved
+    # VM. Batches can be nested.
+    #
+    #   with dc.batch():
+    #       dc.remove(vm.ip)
+    #       dc.place(vm, m)
+    @contextlib.contextmanager
+    def batch(self):
+        with self.lock.writing():
+            self._update()
+            self._batching += 1
+            try:
+                yield self
+            finally:
+                self._batching -= 1
+                if not self._batching:
+                    self._rebalance()
+
+    # Any number of threads can query the data center at once, and one at a
+    # time can change it; every public method takes care of that itself. A
+    # batch holds the data center for its whole length, so other threads see
+    # all of it or none of it.
+    #
+    # To look at several things at once without anything changing in
+    # between, including the VMs' own transfers dicts, hold reading():
+    #
+    #   with dc.reading():
+    #       left = sum(vm.transfers.itervalues())
+    #
+    # Queries made inside it see the data center as it was when it started.
+    # Changing the data center inside it raises an error.
+    @contextlib.contextmanager
+    def reading(self):
+        self._update()
+        with self.lock.reading():
+            yield self
+
+    # Apply a list of moves to the data center all at once. Each move is one
+    # of ('place', vm, machine), ('remove', vm), ('move', vm, machine) or
+    # ('swap', vm1, vm2). The whole list is checked before anything happens,
+    # and if any move is impossible an error is raised and nothing changes.
+    # Returns a list with the new ip for each place or move, and None for the
+    # others.
+    @_writer
+    def apply(self, moves):
+        self._update()
+        self._check_moves(moves)
+
+        results = []
+        with self.batch():
+            for move in moves:
+                op, vm = move[0], move[1]
+                if op == 'place':
+                    results.append(self.place(vm, move[2]))
+                elif op == 'remove':
+                    results.append(self.remove(vm.ip))
+                elif op == 'move':
+                    self.remove(vm.ip)
+                    results.append(self.place(vm, move[2]))
+                else:
+                    m1, m2 = vm.machine, move[2].machine
+                    self.remove(vm.ip)
+                    self.remove(move[2].ip)
+                    self.place(vm, m2)
+                    self.place(move[2], m1)
+                    results.append(None)
+        return results
+
+    # Make sure a list of moves for apply() can all be carried out, in order
+    def _check_moves(self, moves):
+        free = {}  # open slots on each machine we have touched
+        where = {}  # where each VM we have touched would be, or None
+
+        def locate(vm):
+            if vm not in where:
+                where[vm] = vm.machine if vm.handle is not None else None
+            return where[vm]
+
+        def take(m):
+            if m not in self.machines:
+                raise Exception('Not a valid machine ID')
+            n = free.get(m, self.machines[m].occupancy())
+            if not n:
+                raise Exception('Machine ' + str(m) + ' is full')
+            free[m] = n - 1
+
+        def give(m):
+            free[m] = free.get(m, self.machines[m].occupancy()) + 1
+
+        for move in moves:
+            op, vm = move[0], move[1]
+            if op not in ('place', 'remove', 'move', 'swap'):
+                raise Exception('Unknown move: ' + str(op))
+            if op == 'place':
+                if locate(vm) is not None:
+                    raise Exception('VM ' + str(vm.ID) +
+                                    ' is already in the system.')
+                take(move[2])
+                where[vm] = move[2]
+                continue
+
+            if locate(vm) is None:
+                raise Exception('VM ' + str(vm.ID) + ' is not in the system.')
+            if op == 'remove':
+                give(where[vm])
+                where[vm] = None
+            elif op == 'move':
+                give(where[vm])
+                take(move[2])
+                where[vm] = move[2]
+            else:
+                other = move[2]
+                if locate(other) is None:
+                    raise Exception('VM ' + str(other.ID) +
+                                    ' is not in the system.')
+                where[vm], where[other] = where[other], where[vm]
+
     # Place VM v on machine m, or return False if it is full
+    @_writer
     def place(self, v, m):
         self._update()
-        if v in self.VMs.values():
+        if v.handle is not None:
             raise Exception('VM ' + str(v.ID) + ' is already in the system.')
         if m not in self.machines:
             raise Exception('Not a valid machine ID')
 
         if self.machines[m].add_vm(v):
-            ip = self._get_rand_ip()  # get an IP
-            self.VMs[ip] = v  # index VM by IP
+            # give the VM a handle, which also makes its ip
+            if self._free_handles:
+                v.handle = self._free_handles.pop()
+                self._vms[v.handle] = v
+            else:
+                v.handle = len(self._vms)
+                self._vms.append(v)
+            ip = v.ip
             v.machine = m
-            v.ip = ip
             v.in_network = True
+            if self.trace is not None:
+                self.trace.place(v, m)
+            self.events.post(VM_PLACED, self.time - self.start_time,
+                             v.user, vm=v, machine=m)
+
+            # this VM's data now counts towards its user's totals
+            acct = self.users[v.user]
+            acct.add_vms(1, self.time)
+            acct.members.add(v)
+            if v.transfers:
+                acct.transfers += len(v.transfers)
+                acct.remaining += sum(v.transfers.itervalues())
+                acct.completed = None
 
             counter = 0
             # add a link for each one of this VM's connections in the system
             for target in v.transfers:
-                if target in self.VMs.values():
+                self._incoming[target].add(v)
+                if target.handle is not None:
                     self._add_link(v, target)
                     counter += 1
 
             # check to see if other VMs in the system link to the new one
-            for u in self.VMs.values():
-                if v in u.transfers.iterkeys():
-                    self._add_link(u, v)
-                    counter += 1
+            for u in self._incoming.get(v, ()):
+                self._add_link(u, v)
+                counter += 1
+
+            if not self._batching:
+                self._rebalance()
 
             if VERBOSE:
                 print 'Added VM with ip', ip, 'to machine', m
@@ -99,14 +458,11 @@ class DataCenter(object):
 
     # Place VM v on a random machine. Return the machine's id and the VM's ip
     # if successful, or raise an error if the entire datacenter is full.
+    @_writer
     def random_place(self, v):
-        self._update()
-        try:
-            # Make a list of machines with some capacity, and choose randomly
-            m = random.choice([i for i in range(self.NUM_MACHINES) 
-                     if self.machines[i].occupancy() > 0])
-        except IndexError:
-            # If the list of valid machines is empty, the whole center is full
+        m = self.random_machine()
+        if m is None:
+            # If no machine has any capacity, the whole center is full
             raise Exception('No machines available')
 
         if VERBOSE:
@@ -114,237 +470,445 @@ class DataCenter(object):
         return m, self.place(v, m)
 
     # Remove VM with ip from the network
+    @_writer
     def remove(self, ip):
         v = self.VMs[ip]
         v.in_network = False
 
         # Remove all the active outgoing links from this VM
-        for u in v.active_transfers.values():
+        for u in v.active_transfers.keys():
             self._remove_link(v, u)
 
         # Find all incoming links and remove those, too
-        it = [u for u in self.VMs.values() if v in u.active_transfers.values()]
-
-        for u in it:
-            self._remove_link(u, v)
-
-        del self.VMs[v.ip]
+        for u in self._incoming.get(v, ()):
+            if v in u.active_transfers:
+                self._remove_link(u, v)
+
+        # This VM won't be sending anything until it comes back
+        for target in v.transfers:
+            self._drop_incoming(v, target)
+
+        # free the handle; the VM's old ip no longer finds it
+        self._vms[v.handle] = None
+        self._free_handles.append(v.handle)
+        v.handle = None
         self.machines[v.machine].remove_vm(v)
+        if self.trace is not None:
+            self.trace.remove(v)
+        self.events.post(VM_REMOVED, self.time - self.start_time, v.user,
+                         vm=v, machine=v.machine)
+
+        # and whatever it had left doesn't any more
+        acct = self.users[v.user]
+        acct.add_vms(-1, self.time)
+        acct.members.discard(v)
+        acct.transfers -= len(v.transfers)
+        acct.remaining -= sum(v.transfers.itervalues())
+        if not acct.transfers:
+            acct.remaining = 0.0
+        if not self._batching:
+            self._rebalance()
 
     # Return the number of bytes left to transfer between u and v
     # TODO: find out what this actually means
+    @_reader
     def progress(self, u, v):
-        self._update()
         return u.to_transfer(v) + v.to_transfer(u)
 
+    # Return the data left and the current rate of every transfer user usr's
+    # VMs in the network still have to make, all as of one update, as
+    # (pairs, remaining, rates): pairs is a list of (src, dst) VMs, remaining
+    # an array of the MB left on each and rates an array of their MBPS. A
+    # transfer which isn't running, because its destination isn't in the
+    # network, has a rate of 0.
+    @_reader
+    def tenant_progress(self, usr):
+        return self._tenant_transfers(usr)
+
+    # Return the k running transfers of user usr's VMs which will take the
+    # longest to finish at their current rates, slowest first, as a list of
+    # (src, dst, remaining MB, MBPS, seconds left).
+    @_reader
+    def slowest_transfers(self, usr, k=1):
+        pairs, remaining, rates = self._tenant_transfers(usr)
+        running = np.flatnonzero(rates > 0)
+        if not len(running) or k <= 0:
+            return []
+
+        eta = remaining[running] / rates[running]
+        if k < len(running):
+            top = np.argpartition(-eta, k - 1)[:k]
+        else:
+            top = np.arange(len(running))
+        top = top[np.argsort(-eta[top], kind='mergesort')]
+        return [pairs[running[i]] + (remaining[running[i]],
+                                     rates[running[i]], eta[i])
+                for i in top.tolist()]
+
+    def _tenant_transfers(self, usr):
+        acct = self.users.get(usr)
+        pairs, remaining, cids = [], [], []
+        for u in (acct.members if acct is not None else ()):
+            active = u.active_transfers
+            for v, amt in u.transfers.iteritems():
+                pairs.append((u, v))
+                remaining.append(amt)
+                cids.append(active.get(v))
+
+        rate = self.engine.rate
+        rates = np.array([0.0 if cid is None else rate(cid) for cid in cids])
+        return pairs, np.array(remaining, dtype=float), rates
+
     # Get the total amount of time a user has clocked
+    @_reader
     def user_time(self, usr):
-        self._update()
-        return self.users[usr][0]
+        return self.users.get(usr, UserStats()).seconds(self.time)
+
+    # Return the running totals for user usr, as a dict: the VMs they have
+    # in the network, the data (in MB) those VMs have left to send and the
+    # data sent so far, the VM-seconds used, and the time (since the data
+    # center started) their last transfer finished, or None if some are left.
+    @_reader
+    def user_stats(self, usr):
+        acct = self.users.get(usr, UserStats())
+        completed = acct.completed
+        return {
+            'vms': acct.vms,
+            'remaining': max(acct.remaining, 0.0),
+            'done': acct.done,
+            'vm_seconds': acct.seconds(self.time),
+            'completed': None if completed is None
+                         else completed - self.start_time,
+        }
 
     # Return the number of slots open on machine m
+    @_reader
     def machine_occupancy(self, m):
-        self._update()
         return self.machines[m].occupancy()
 
-    # Returns the throughput of the TCP connection from u -> v over
-    # the last 100ms
-    # TODO: figure out how - this gets the current link speed; not the same
-    def tcp_throughput(self, u, v):
+    # Return the number of slots open on every machine and in every group at
+    # once, as (version, machines, groups). Pass the version of an earlier
+    # snapshot as since to get only the machines which have changed, as a
+    # dict of machine: open slots. See FreeSlots.snapshot.
+    @_reader
+    def occupancy(self, since=None):
+        return self.free_slots.snapshot(since)
+
+    # Return a random machine with an open slot, or None if they are all full
+    @_reader
+    def random_machine(self):
+        return self.free_slots.random_machine()
+
+    # Return the first machine in group g with an open slot, or None
+    @_writer
+    def first_free_machine(self, g):
         self._update()
-        return self._get_link_speed(self._get_group(u), self._get_group(v))
+        return self.free_slots.first_in_group(g)
 
-    # Prints out a full representation of everything in the system right now
-    def draw_status(self):
+    # Return the group with the most open slots
+    @_writer
+    def emptiest_group(self):
         self._update()
+        return self.free_slots.emptiest_group()
+
+    # Return the total amount of data (in MB) sent over the core links so far
+    @_reader
+    def core_traffic(self):
+        active = set().union(*self.core_links.values())
+        return self._core_sent - sum(self.engine.remaining(cid, self.time)
+                                     for cid in active)
+
+    # Returns the average throughput (in MBPS) of the TCP connection from
+    # u -> v over the last window seconds, 100ms by default
+    @_reader
+    def tcp_throughput(self, u, v, window=0.1):
+        return self.telemetry.throughput(u, v, self.time, window)
+
+    # Returns the average throughput (in MBPS) over a link in the last window
+    # seconds. link is a key of agg_links or core_links.
+    @_reader
+    def link_throughput(self, link, window=0.1):
+        return self.telemetry.link_throughput(link, self.time, window)
+
+    # Returns the recent history of the throughput over a link, as arrays
+    # (times, rates): it carried rates[i] MBPS from times[i] (seconds since
+    # the data center started) until times[i + 1], and carries rates[-1] now.
+    # Only the last few dozen changes are kept.
+    @_reader
+    def link_history(self, link):
+        times, rates = self.telemetry.link_history(link)
+        return times - self.start_time, rates
+
+    # Prints out a full representation of everything in the system, as of
+    # the last update. This is throttled to a few times a second unless force
+    # is set, and does nothing if renderer.enabled is False; see status.py.
+    def draw_status(self, force=False):
+        return self.renderer.refresh(force)
+
+    # Call f(self, *args, **kwargs) for public method name, and record how
+    # long it took
+    def _timed(self, name, f, args, kwargs):
+        metrics = self.metrics
+        start = time.time()
+        try:
+            return f(self, *args, **kwargs)
+        finally:
+            metrics.called(name, time.time() - start)
 
-        # clear the screen
-        print chr(27) + "[2J"
-
-        # print the system time
-        print bcolors.HEADER + 'SYSTEM TIME: ' + bcolors.ENDC +\
-                str(self.time - self.start_time) + '\n'
-
-        # print link congestion stats: how many connections are using each?
-        print bcolors.HEADER + 'LINK CONGESTION:' + bcolors.ENDC
-        print bcolors.GREEN + ' * core links: ' + bcolors.ENDC +\
-                    '; '.join(str(l) + ': ' + 
-                    bcolors.YELLOW + str(len(num)) + bcolors.ENDC 
-                    for l, num in self.core_links.items())
-
-        print bcolors.GREEN + ' * aggregate links:\n   ' + bcolors.ENDC +\
-            '\n   '.join(
-                    '; '.join(str(l[0]) + '<->' + str(l[1]) + ': ' + 
-                        bcolors.YELLOW + str(len(num)) + bcolors.ENDC
-            for l, num in sorted(self.agg_links.items()) if l[1] == i) 
-            for i in range(self.AGG_ROUTERS)) 
-
-        # print the number of VMs in each group
-        print bcolors.HEADER + '\nTOTAL VMs BY GROUP:' + bcolors.ENDC
-        print '   ' + '\n   '.join(
-                '  '.join(str(g) + ': ' + 
-                    bcolors.YELLOW + 
-                        str(sum(len(m.VMs) for m in self.groups[g])) +
-                    bcolors.ENDC
-                    for g in self.groups if int(g/6) == i) 
-                for i in range(self.AGG_ROUTERS))
-
-        # calculate some user stats
-        for u in self.users:
-            vms = [v for v in self.VMs.values() if v.user == u]
-            try:
-                pct = int(sum(v.total_data - sum(v.transfers.values())
-                    for v in vms) / sum(v.total_data for v in vms) * 100)
-            except:
-                pct = 100
-            
-            done = sum(v.total_data - sum(v.transfers.values()) for v in vms)
-            total = sum(v.total_data for v in vms)
-
-            self.users[u][1] = str(len(vms))
-            self.users[u][2] = str(int(done)) + '/' + str(total) + ' MB = ' + str(pct) + '%'
-
-        # print some stats for each user
-        print bcolors.HEADER + '\nUSER: TIME, VMs, % COMPLETION:' +\
-                bcolors.ENDC
-        print '   ' + '\n   '.join(
-                'ID ' + str(usr) + ': ' + 
-                bcolors.YELLOW + 
-                str(val[0]) + ', ' + val[1] + ', ' + val[2] +
-                bcolors.ENDC 
-                for usr, val in self.users.items() if usr >= 0)
-
-    # Get a random, unused ip for a VM
-    def _get_rand_ip(self):
-        # append 4 random bytes, with periods, in a string
-        rand_ip = lambda: '.'.join([str(random.randrange(256)) 
-                                    for i in range(4)])
-        ip = rand_ip()
-        while ip in self.VMs:  # try until we find one we haven't used
-            ip = rand_ip()
-        return ip
-    
     # What group is this VM in? 
     def _get_group(self, vm):
-        return int(vm.machine / self.GROUP_SIZE)
+        return self.topology.group_of[vm.machine]
 
     # Add a link between two machines
     def _add_link(self, vm1, vm2):
-        m1 = vm1.machine
-        m2 = vm2.machine
         g1 = self._get_group(vm1)
         g2 = self._get_group(vm2)
 
-        vm1.activate_transfer(vm2, vm2.ip)
+        cid = self.engine.add(vm1, vm2, g1, g2, vm1.transfers[vm2], self.time)
+        vm1.activate_transfer(vm2, cid)
+        self.telemetry.start(vm1, vm2, cid, g1, g2, self.time)
+        if self.trace is not None:
+            self.trace.start(vm1, vm2, vm1.transfers[vm2])
+        if self.metrics is not None:
+            self.metrics.count('links_added')
+        self._changed.add(cid)
 
         if g1 == g2:  # Don't add anything if they're in the same group
             return
 
-        ag1 = int(g1 / 6)
-        ag2 = int(g2 / 6)
+        ag1 = self.topology.agg_of[g1]
+        ag2 = self.topology.agg_of[g2]
+
+        self._pairs[(g1, g2)].add(cid)
+        self.model.join(g1, g2)
 
         # Add the vm connection to the (group -> aggregate group) links
-        self.agg_links[(g1, ag1)].add((vm1.ip, vm2.ip)) 
-        self.agg_links[(g2, ag2)].add((vm1.ip, vm2.ip)) 
+        self.agg_links[(g1, ag1)].add(cid)
+        self.agg_links[(g2, ag2)].add(cid)
+        self._touched_agg.update([(g1, ag1), (g2, ag2)])
 
         # Add the connection to the (aggregate -> core) links
         if ag1 != ag2:
-            self.core_links[ag1].add((vm1.ip, vm2.ip))
-            self.core_links[ag2].add((vm1.ip, vm2.ip))
+            self._core_sent += vm1.transfers[vm2]
+            self.core_links[ag1].add(cid)
+            self.core_links[ag2].add(cid)
+            self._touched_core.update([ag1, ag2])
+
+        if self.events.congestion is not None:
+            self._check_congestion([(g1, ag1), (g2, ag2)],
+                                   [ag1, ag2] if ag1 != ag2 else [], 0)
 
     # Delete a link between two machines
     def _remove_link(self, vm1, vm2):
-        m1 = vm1.machine
-        m2 = vm2.machine
         g1 = self._get_group(vm1)
         g2 = self._get_group(vm2)
 
-        vm1.deactivate_transfer(vm2.ip)
+        cid = vm1.deactivate_transfer(vm2)
+        amt = self.engine.remove(cid, self.time)
+        self._changed.discard(cid)
+        self.telemetry.stop(cid, self.time)
+        if self.metrics is not None:
+            self.metrics.count('links_removed')
+
+        # write back whatever is left if the transfer didn't finish
+        if vm2 in vm1.transfers:
+            self._sent(vm1, vm2, vm1.transfers[vm2] - amt)
+            vm1.transfers[vm2] = amt
+            if self.trace is not None:
+                self.trace.stop(vm1, vm2, amt)
 
         if g1 == g2:
             return
 
-        ag1 = int(g1 / 6)
-        ag2 = int(g2 / 6)
+        ag1 = self.topology.agg_of[g1]
+        ag2 = self.topology.agg_of[g2]
+
+        pair = self._pairs[(g1, g2)]
+        pair.remove(cid)
+        if not pair:
+            del self._pairs[(g1, g2)]
+        self.model.leave(g1, g2)
 
         # remove the connection from the (group -> aggregate group) links
-        self.agg_links[(g1, ag1)].remove((vm1.ip, vm2.ip)) 
-        self.agg_links[(g2, ag2)].remove((vm1.ip, vm2.ip)) 
+        self.agg_links[(g1, ag1)].remove(cid)
+        self.agg_links[(g2, ag2)].remove(cid)
+        self._touched_agg.update([(g1, ag1), (g2, ag2)])
 
         # remove the connection from the (aggregate -> core) links
         if ag1 != ag2:
-            self.core_links[ag1].remove((vm1.ip, vm2.ip))
-            self.core_links[ag2].remove((vm1.ip, vm2.ip))
+            self._core_sent -= amt
+            self.core_links[ag1].remove(cid)
+            self.core_links[ag2].remove(cid)
+            self._touched_core.update([ag1, ag2])
+
+        if self.events.congestion is not None:
+            self._check_congestion([(g1, ag1), (g2, ag2)],
+                                   [ag1, ag2] if ag1 != ag2 else [], 1)
+
+    # Publish an event for each of the links which has just reached the
+    # congestion threshold, or, if the connection was removed, just dropped
+    # below it
+    def _check_congestion(self, agg, core, removed):
+        bus = self.events
+        kind = LINK_CLEARED if removed else LINK_CONGESTED
+        t = self.time - self.start_time
+        for links, keys in ((self.agg_links, agg), (self.core_links, core)):
+            for link in keys:
+                n = len(links[link])
+                if n + removed == bus.congestion:
+                    bus.post(kind, t, link=link, connections=n)
+
+    # u no longer has anything to send to v
+    def _drop_incoming(self, u, v):
+        sources = self._incoming.get(v)
+        if sources is not None:
+            sources.discard(u)
+            if not sources:
+                del self._incoming[v]
+
+    # Give new speeds to the new connections, and to the ones between every
+    # pair of groups whose speed has changed since the last call
+    def _rebalance(self):
+        changed = self._changed
+        for pair in self.model.update(self._touched_agg, self._touched_core):
+            changed.update(self._pairs.get(pair, ()))
+        self.speeds = self.model.speeds
+
+        self.engine.rerate(changed, self.speeds, self.time)
+        self.telemetry.rates(self.engine, changed, self.time)
+        if self.trace is not None:
+            self.trace.rates(self.engine, changed)
+
+        self._changed = set()
+        self._touched_agg.clear()
+        self._touched_core.clear()
+
+        if not self._batching:
+            self._dispatch()
+
+    # Deliver the events which have been posted so far. Subscribers may post
+    # more, or make changes which deliver them; either way they go out in
+    # order.
+    def _dispatch(self):
+        pending = self.events.pending
+        while pending:
+            event = pending.popleft()
+            for callback in self.events.listeners(event):
+                if self.metrics is not None:
+                    timed(self.metrics, callback, event)
+                else:
+                    callback(event)
 
     # What is the throughput (in MBPS) between two groups?
-    # This assumes that all connections are given equal speeds
     def _get_link_speed(self, g1, g2):
-        if g1 == g2:
-            return self.THROUGHPUT
-
-        ag1 = int(g1 / 6)
-        ag2 = int(g2 / 6)
-
-        # hacky 1-liner to grab all links
-        links = [self.agg_links[(g1, ag1)],
-                 self.agg_links[(g2, ag2)]] +\
-                ([self.core_links[ag1], self.core_links[ag2]] \
-                  if ag1 != ag2 else [])
-
-        # count the connections on all the links between g1 & g2, 
-        # and take the max
-        max_connects = max(len(link) for link in links)
-
-        # we can't actually have throughput greater than 10 mbps
-        return 2 * self.THROUGHPUT / max(max_connects, 2)
+        if self.metrics is not None:
+            self.metrics.count('link_speed_lookups')
+        return self.speeds[g1][g2]
 
     # Update the state of the data center
     def _update(self):
-        if not self.running:
+        if self.metrics is not None:
+            self.metrics.count('updates')
+
+        # a thread holding the read lock sees things as they were
+        if self.lock.read_only():
             return
 
-        now = time.time()
-        delta_t = now - self.time
-        mttc = float('inf')  # min time to completion
-        
-        vms = self.VMs.values()
-        for u in vms:
+        with self.lock.writing():
+            if not self.running or self._batching:
+                return
+
+            # the virtual clock only moves in run_until()
+            self._advance(self.time if self.virtual else time.time())
+
+    # Bring the data center forward to time target. This jumps from one
+    # completion to the next, finishing every transfer due at that instant
+    # in one step, and only re-rates the connections whose links changed.
+    def _advance(self, target):
+        for u in self.VMs.values():
             if not u.in_network:
                 self.remove(u.ip)
-            for v in u.active_transfers.values():
-                amt = u.transfers[v]
-                tp = self._get_link_speed(
-                        self._get_group(u), self._get_group(v))
-                mttc = min(mttc, amt / tp)
-
-        # If the first connection would have finished by now, roll forward
-        # to the point in time that it ended, and recalculate stuff
-        if mttc < delta_t:
-            self._roll_forward(mttc)
-            self._set_time(self.time + mttc)
-            self._update()
-        else:  # Otherwise, roll forward to the present
-            self._roll_forward(delta_t)
-            self._set_time(now)
+        self._rebalance()
+
+        t = self.engine.next_time()
+        steps = 0
+        while t <= target:
+            self._set_time(t)
+            self._complete(self.engine.pop_due(t))
+            t = self.engine.next_time()
+            steps += 1
+        if self.metrics is not None:
+            self.metrics.advanced(steps)
+
+        # Otherwise, roll forward to the target
+        self._roll_forward(max(target - self.time, 0))
+
+    # Finish off a batch of connections which all completed just now
+    def _complete(self, cids):
+        done = [self.engine.endpoints(cid) for cid in cids]
+        self.completed += len(done)
+        t = self.time - self.start_time
+        for u, v in done:
+            if v in u.active_transfers:
+                if self.trace is not None:
+                    self.trace.end(u, v)
+                last = self._finished(u, v)
+                del u.transfers[v]
+                self.events.post(TRANSFER_COMPLETE, t, u.user, vm=u, other=v)
+                self._remove_link(u, v)
+                self._drop_incoming(u, v)
+                if last:
+                    self.events.post(TENANT_FINISHED, t, u.user)
+        self._dispatch()
+
+        # the completion callbacks may have taken VMs out of the network
+        for pair in done:
+            for u in pair:
+                if not u.in_network and u.handle is not None:
+                    self.remove(u.ip)
+
+        self._rebalance()
+
+    # u has sent another amt MB to v
+    def _sent(self, u, v, amt):
+        acct = self.users[u.user]
+        acct.done += amt
+        acct.remaining -= amt
+        if u.on_transfer_progress is not None and amt:
+            if self.metrics is not None:
+                timed(self.metrics, u.on_transfer_progress, u, v, amt)
+            else:
+                u.on_transfer_progress(u, v, amt)
+
+    # u has sent the last of its data to v. Returns True if that was the
+    # last transfer u's user had left.
+    def _finished(self, u, v):
+        self._sent(u, v, u.transfers[v])
+        acct = self.users[u.user]
+        acct.transfers -= 1
+        if not acct.transfers:
+            acct.remaining = 0.0
+            acct.completed = self.time
+            return True
+        return False
 
     # Set a new time
     def _set_time(self, time):
+        moved = time != self.time
         self.time = time
+        if moved and self.trace is not None:
+            self.trace.advance()
         if VERBOSE:
             print 'System time updated to', self.time, '+', \
                 self.time - self.start_time
 
-    # Jump forward in time, and transfer data along all active connections
-    # at their current rates.
+    # Jump forward in time, and bring the data left on every active
+    # connection up to date at their current rates.
     def _roll_forward(self, delta):
-        vms = self.VMs.values()
-        for u in vms:
-            self.users[u.user][0] += delta
-
-            for v in u.active_transfers.values():
-                tp = self._get_link_speed(
-                        self._get_group(u), self._get_group(v))
-
-                if u.transfer(v.ip, tp * delta):
-                    if u.in_network:
-                        self._remove_link(u, v)
+        self._set_time(self.time + delta)
+        settled = self.engine.settle(self.time)
+        if self.metrics is not None:
+            self.metrics.count('roll_forward_visits', len(settled))
+        for u, v, amt in settled:
+            self._sent(u, v, u.transfers[v] - amt)
+            u.transfers[v] = amt
@@ -0,0 +1,274 @@
+import heapq, itertools
+import numpy as np
+
+# Two events less than this many seconds apart are treated as simultaneous
+EPSILON = 10 ** -9
+
+# Engines keep track of every active connection between two VMs: how much
+# data it has left, how fast it is going and when it will finish. Both engines
+# below have the same interface, and a connection is known by the integer id
+# returned from add(). DataCenter takes the engine class as an argument.
+
+# An active transfer from VM src in group g1 to VM dst in group g2. remaining
+# is the amount of data (in MB) left to send as of time stamp; after that it
+# drains at rate MBPS.
+class Connection(object):
+    __slots__ = ('src', 'dst', 'g1', 'g2', 'remaining', 'rate', 'stamp',
+                 'version')
+
+    def __init__(self, src, dst, g1, g2, remaining, stamp):
+        self.src = src
+        self.dst = dst
+        self.g1 = g1
+        self.g2 = g2
+        self.remaining = remaining
+        self.rate = 0.0
+        self.stamp = stamp
+        self.version = 0
+
+    # Bring the amount of data left up to date with time t
+    def settle(self, t):
+        self.remaining -= self.rate * (t - self.stamp)
+        self.stamp = t
+
+    # When will this connection finish at its current rate?
+    def finish_time(self):
+        return self.stamp + max(self.remaining, 0) / self.rate
+
+
+# Keeps every active connection and a heap of predicted completion times.
+# A connection is only brought up to date when its rate changes, so each
+# event costs as much as the connections it touches rather than all of them.
+# Heap entries are (time, connection id, version); an entry is stale once the
+# connection has been removed or re-rated since it was pushed.
+class EventEngine(object):
+    def __init__(self):
+        self.conns = {}
+        self.heap = []
+        self.ids = itertools.count()
+        self.settled = None  # last time settle() brought everything up to date
+
+    def __len__(self):
+        return len(self.conns)
+
+    # Start a connection from src in group g1 to dst in group g2 with amt MB
+    # to send, and return its id. It doesn't move any data until it is given
+    # a rate.
+    def add(self, src, dst, g1, g2, amt, t):
+        cid = next(self.ids)
+        self.conns[cid] = Connection(src, dst, g1, g2, amt, t)
+        return cid
+
+    # Stop a connection at time t and return how much data it had left
+    def remove(self, cid, t):
+        c = self.conns.pop(cid)
+        c.settle(t)
+        return max(c.remaining, 0)
+
+    # How much data does connection cid have left at time t?
+    def remaining(self, cid, t):
+        c = self.conns[cid]
+        return max(c.remaining - c.rate * (t - c.stamp), 0)
+
+    def rate(self, cid):
+        return self.conns[cid].rate
+
+    # The (src, dst) VMs of connection cid
+    def endpoints(self, cid):
+        c = self.conns[cid]
+        return c.src, c.dst
+
+    # Change the rate of a connection from time t onwards, and re-predict its
+    # completion. Returns True if the rate actually changed.
+    def set_rate(self, cid, rate, t):
+        c = self.conns[cid]
+        if c.rate == rate:
+            return False
+
+        c.settle(t)
+        c.rate = rate
+        c.version += 1
+        if rate > 0:
+            heapq.heappush(self.heap, (c.finish_time(), cid, c.version))
+        return True
+
+    # Give each of the connections in cids the speed between its two groups
+    # in the table speeds, from time t onwards
+    def rerate(self, cids, speeds, t):
+        conns = self.conns
+        for cid in cids:
+            c = conns[cid]
+            self.set_rate(cid, speeds[c.g1][c.g2], t)
+
+    # The time of the next completion, or infinity if nothing is running
+    def next_time(self):
+        heap = self.heap
+        while heap:
+            t, cid, version = heap[0]
+            c = self.conns.get(cid)
+            if c is not None and c.version == version:
+                return t
+            heapq.heappop(heap)
+        return float('inf')
+
+    # Pop the ids of every connection which finishes at the next completion
+    # time, as long as that is no later than t. The connections stay in the
+    # engine, stopped, until they are removed.
+    def pop_due(self, t):
+        due = []
+        first = self.next_time()
+        if first > t:
+            return due
+
+        heap = self.heap
+        while heap and heap[0][0] <= first + EPSILON:
+            _, cid, version = heapq.heappop(heap)
+            c = self.conns.get(cid)
+            if c is not None and c.version == version:
+                c.remaining = 0
+                c.stamp = first
+                c.rate = 0.0
+                due.append(cid)
+        return due
+
+    # Bring every connection up to date with time t, and return (src, dst,
+    # remaining) for the ones whose remaining data may have changed since
+    # the last call.
+    def settle(self, t):
+        if t == self.settled:
+            return ()
+
+        self.settled = t
+        for c in self.conns.itervalues():
+            c.settle(t)
+        return [(c.src, c.dst, max(c.remaining, 0))
+                for c in self.conns.itervalues()]
+
+
+# Keeps every active connection in a row of parallel NumPy arrays, so that
+# moving time forward, finding the next completion and finding the finished
+# transfers are each one vectorized operation over all of them. Unlike
+# EventEngine, every connection is always up to date with the engine's clock.
+# Connection ids are row numbers, and rows are reused once freed.
+class ArrayEngine(object):
+    def __init__(self, capacity=64):
+        self.src = [None] * capacity
+        self.dst = [None] * capacity
+        self.g1 = np.zeros(capacity, dtype=np.int32)
+        self.g2 = np.zeros(capacity, dtype=np.int32)
+        self.mb = np.zeros(capacity)  # data left
+        self.mbps = np.zeros(capacity)  # current rate
+        self.active = np.zeros(capacity, dtype=bool)
+
+        self.free = range(capacity - 1, -1, -1)  # free rows, lowest on top
+        self.count = 0
+        self.stamp = None  # time the remaining column is up to date with
+        self.settled = None  # last time settle() was called
+        self.next = None  # cached next completion time
+
+    def __len__(self):
+        return self.count
+
+    # Double the size of every column
+    def _grow(self):
+        n = len(self.src)
+        self.src.extend([None] * n)
+        self.dst.extend([None] * n)
+        for name in ('g1', 'g2', 'mb', 'mbps', 'active'):
+            col = getattr(self, name)
+            setattr(self, name, np.concatenate([col, np.zeros_like(col)]))
+        self.free = range(2 * n - 1, n - 1, -1) + self.free
+
+    # Move every connection forward to time t at its current rate
+    def _advance(self, t):
+        if self.stamp is not None and t != self.stamp:
+            self.mb -= self.mbps * (t - self.stamp)
+        self.stamp = t
+
+    def add(self, src, dst, g1, g2, amt, t):
+        self._advance(t)
+        if not self.free:
+            self._grow()
+
+        cid = self.free.pop()
+        self.src[cid] = src
+        self.dst[cid] = dst
+        self.g1[cid] = g1
+        self.g2[cid] = g2
+        self.mb[cid] = amt
+        self.mbps[cid] = 0
+        self.active[cid] = True
+        self.count += 1
+        return cid
+
+    def remove(self, cid, t):
+        self._advance(t)
+        amt = max(self.mb[cid], 0)
+        self.src[cid] = self.dst[cid] = None
+        self.mb[cid] = 0
+        self.mbps[cid] = 0
+        self.active[cid] = False
+        self.free.append(cid)
+        self.count -= 1
+        self.next = None
+        return amt
+
+    def remaining(self, cid, t):
+        return max(self.mb[cid] - self.mbps[cid] * (t - self.stamp), 0)
+
+    def rate(self, cid):
+        return self.mbps[cid]
+
+    def endpoints(self, cid):
+        return self.src[cid], self.dst[cid]
+
+    def set_rate(self, cid, rate, t):
+        if self.mbps[cid] == rate:
+            return False
+        self._advance(t)
+        self.mbps[cid] = rate
+        self.next = None
+        return True
+
+    def rerate(self, cids, speeds, t):
+        if not cids:
+            return
+        self._advance(t)
+        rows = np.fromiter(cids, dtype=np.intp, count=len(cids))
+        self.mbps[rows] = np.asarray(speeds)[self.g1[rows], self.g2[rows]]
+        self.next = None
+
+    def next_time(self):
+        if self.next is None:
+            running = self.mbps > 0
+            if running.any():
+                self.next = self.stamp + np.min(
+                        np.maximum(self.mb[running], 0) /
+                        self.mbps[running])
+            else:
+                self.next = float('inf')
+        return self.next
+
+    def pop_due(self, t):
+        first = self.next_time()
+        if first > t:
+            return []
+
+        limit = self.mbps * (first - self.stamp + EPSILON)
+        due = np.flatnonzero((self.mbps > 0) & (self.mb <= limit))
+        self._advance(first)
+        self.mb[due] = 0
+        self.mbps[due] = 0
+        self.next = None
+        return due.tolist()
+
+    def settle(self, t):
+        self._advance(t)
+        if t == self.settled:
+            return ()
+
+        self.settled = t
+        rows = np.flatnonzero(self.active)
+        left = np.maximum(self.mb[rows], 0).tolist()
+        return [(self.src[i], self.dst[i], amt)
+                for i, amt in itertools.izip(rows.tolist(), left)]
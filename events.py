@@ -0,0 +1,114 @@
+import itertools
+from collections import deque
+
+# The data center publishes what happens in it on an event bus, dc.events, so
+# that servers can react to the changes they care about as they happen
+# instead of polling for them:
+#
+#   def done(event):
+#       print event.vm.ID, 'finished sending to', event.other.ID
+#   dc.events.subscribe(TRANSFER_COMPLETE, done, user=3)
+#
+# Events are queued as they happen and delivered once the data center is in
+# a consistent state again: after every transfer finishing at the same
+# instant has been dealt with, at the end of a place() or remove(), and at
+# the end of a batch. Subscribers are called holding the data center's lock,
+# in the order they subscribed.
+#
+# Every VM's on_transfer_complete callback is called by a subscriber the
+# data center makes for itself, so it works as it always has.
+
+# A transfer finished: vm sent the last of its data to other
+TRANSFER_COMPLETE = 'transfer_complete'
+# vm was placed on machine, or removed from it
+VM_PLACED = 'vm_placed'
+VM_REMOVED = 'vm_removed'
+# the number of connections on link reached the congestion threshold, or
+# dropped back below it
+LINK_CONGESTED = 'link_congested'
+LINK_CLEARED = 'link_cleared'
+# the last transfer of user's VMs in the network finished
+TENANT_FINISHED = 'tenant_finished'
+
+KINDS = (TRANSFER_COMPLETE, VM_PLACED, VM_REMOVED, LINK_CONGESTED,
+         LINK_CLEARED, TENANT_FINISHED)
+
+# One thing that happened. time is in seconds since the data center started,
+# and the fields which don't apply to the kind of event are None. link is a
+# key of agg_links or core_links, and connections how many it had after the
+# change.
+class Event(object):
+    __slots__ = ('kind', 'time', 'user', 'vm', 'other', 'machine', 'link',
+                 'connections')
+
+    def __init__(self, kind, time, user=None, vm=None, other=None,
+                 machine=None, link=None, connections=None):
+        self.kind = kind
+        self.time = time
+        self.user = user
+        self.vm = vm
+        self.other = other
+        self.machine = machine
+        self.link = link
+        self.connections = connections
+
+    def __repr__(self):
+        fields = ', '.join('%s=%r' % (k, getattr(self, k))
+                           for k in self.__slots__[1:]
+                           if getattr(self, k) is not None)
+        return 'Event(%s, %s)' % (self.kind, fields)
+
+
+class EventBus(object):
+    # congestion is how many connections a link has to carry before it counts
+    # as congested, or None to never publish LINK_CONGESTED or LINK_CLEARED
+    def __init__(self, congestion=None):
+        self.congestion = congestion
+        self.pending = deque()
+        self._subs = {}  # kind: {user or None: [(token, callback)]}
+        self._tokens = {}  # token: (kind, user)
+        self._ids = itertools.count()
+
+    # Call callback(event) for every event of kind from now on. If user is
+    # given, only for the events about that user's VMs. Returns a token for
+    # unsubscribe().
+    def subscribe(self, kind, callback, user=None):
+        if kind not in KINDS:
+            raise Exception('Unknown event: ' + str(kind))
+        token = next(self._ids)
+        self._subs.setdefault(kind, {}).setdefault(user, []).append(
+            (token, callback))
+        self._tokens[token] = (kind, user)
+        return token
+
+    def unsubscribe(self, token):
+        kind, user = self._tokens.pop(token)
+        subs = self._subs[kind]
+        subs[user] = [s for s in subs[user] if s[0] != token]
+        if not subs[user]:
+            del subs[user]
+        if not subs:
+            del self._subs[kind]
+
+    # Would anyone get an event of kind about user?
+    def wanted(self, kind, user=None):
+        subs = self._subs.get(kind)
+        return subs is not None and (None in subs or user in subs)
+
+    # Queue an event, if anyone wants it; see Event for the arguments
+    def post(self, kind, time, user=None, **fields):
+        if self.wanted(kind, user):
+            self.pending.append(Event(kind, time, user, **fields))
+
+    # The callbacks which should get event
+    def listeners(self, event):
+        subs = self._subs.get(event.kind, {})
+        found = list(subs.get(None, ()))
+        if event.user is not None and event.user in subs:
+            found = sorted(found + subs[event.user])
+        return [callback for _, callback in found]
+
+# The data center's own subscriber, which passes a finished transfer on to
+# the VM's on_transfer_complete callback
+def notify_vm(event):
+    event.vm.on_transfer_complete(event.vm, event.other)
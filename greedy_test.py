@@ -1,4 +1,4 @@
-import random, time, itertools, thread
+import sys, random, time, itertools, thread
 from collections import defaultdict
 from machine import Machine, VirtualMachine
 from datacenter import DataCenter
@@ -19,12 +19,13 @@ class GreedyServer(Server):
 
         # try all machines in order
         m = 0
-        for v in sorted_vms:
-            # try to place in the first available spot
-            while not self.dc.place(v, m):
-                m = (m + 1) % self.dc.NUM_MACHINES            
+        with self.dc.batch():
+            for v in sorted_vms:
+                # try to place in the first available spot
+                while not self.dc.place(v, m):
+                    m = (m + 1) % self.dc.NUM_MACHINES            
 
-        dc.draw_status()
+        self.dc.draw_status()
         self.finished = False
 
     # keep updating until everything's finished
@@ -33,17 +34,18 @@ class GreedyServer(Server):
 
         # We are finished when all of our users' VMs are done
         for vm in self.vms:
-            if vm.ip in dc.VMs:
+            if vm.ip in self.dc.VMs:
                 break
         else:
             self.finished = True
 
 if __name__ == '__main__':
     # first, place random users around the network with very large connections
-    dc = DataCenter()
+    dc = DataCenter(virtual='--virtual' in sys.argv)
+    dc.renderer.enabled = '--quiet' not in sys.argv
     fill_datacenter(dc, 20, 10, 10**7)
     dc.draw_status()
-    time.sleep(1)  # Wait one second
+    dc.run_until(dc.now() + 1)  # Wait one second
 
     # initialize everything
     servers = [GreedyServer(i, 20, dc=dc, max_data=100000) for i in range(10)]
@@ -59,4 +61,4 @@ if __name__ == '__main__':
         for s in servers:
             if not s.finished:
                 s.loop()
-        time.sleep(1)
+        dc.run_until(dc.now() + 1)
@@ -1,21 +1,67 @@
+import heapq, random
+from traffic import TrafficMatrix
+
+# VMs in a data center are known by small integer handles, which are only
+# turned into readable ip addresses (10.x.y.z) on the way in and out of the
+# DataCenter API.
+def handle_to_ip(handle):
+    if handle is None:
+        return None
+    return '10.%d.%d.%d' % (handle >> 16 & 255, handle >> 8 & 255, handle & 255)
+
+# The handle behind an ip address, or None if it isn't one of ours
+def ip_to_handle(ip):
+    try:
+        ten, a, b, c = [int(x) for x in ip.split('.')]
+    except (AttributeError, ValueError):
+        return None
+    if ten != 10:
+        return None
+    return a << 16 | b << 8 | c
+
+# The default transfer completion callback, which does nothing
+def _ignore_transfer(vm, other):
+    pass
+
 class VirtualMachine(object):
-    # Initialize the VM. B should be a tuple of n tuples of length n, 
-    # with B[i][j] referencing the j^th column of the i^th row.
+    __slots__ = ('machine', 'handle', 'user', 'ID', 'in_network',
+                 'transfers', 'active_transfers', 'total_data',
+                 'on_transfer_complete', 'on_transfer_progress')
+
     def __init__(self, user, ID):
         self.machine = None
-        self.ip = None
+        self.handle = None  # given out by the data center while placed
         self.user = user
         self.ID = ID
         self.in_network = False
 
+        # Callback for whenever a VM transfer completes - should be replaced.
+        # It is called as on_transfer_complete(self, other).
+        self.on_transfer_complete = _ignore_transfer
+
+        # If set, called as on_transfer_progress(self, other, amt) whenever
+        # the data center finds another amt MB has been sent to other.
+        self.on_transfer_progress = None
+
+    # This VM's ip address, or None if it isn't in a data center
+    @property
+    def ip(self):
+        return handle_to_ip(self.handle)
+
+    # Give the VM its row of the traffic matrix B, with B[u][v] the amount of
+    # data u sends to v. B is a TrafficMatrix (see traffic.py), or a dict of
+    # dicts.
     def activate(self, B):
         # self.transfers keeps track of all the data which still has to
         # be transferred TO any given VM in the system.
-        self.transfers = {vm: B[self][vm] for vm in B 
-                if vm != self and B[self][vm] > 0}
+        if isinstance(B, TrafficMatrix):
+            self.transfers = B.row(self)
+        else:
+            self.transfers = {vm: amt for vm, amt in B[self].iteritems()
+                    if vm != self and amt > 0}
 
-        # active_transfers has the vm for all currently running 
-        # transfers indexed by IP
+        # active_transfers maps the VM at the other end of every currently
+        # running transfer to its connection id
         self.active_transfers = {}
 
         self.total_data = sum(self.transfers.values())
@@ -23,8 +69,7 @@ class VirtualMachine(object):
     # Transfer data from self to another VM
     # return True if the transfer terminated, False otherwise
     # If no value for amount is supplied, transfer all data
-    def transfer(self, ip, amt=None):
-        vm = self.active_transfers[ip]
+    def transfer(self, vm, amt=None):
         if amt == None:
             del self.transfers[vm]
             self.on_transfer_complete(self, vm)
@@ -51,30 +96,31 @@ class VirtualMachine(object):
         except:
             return 0
 
-    # Begin transferring data to another VM
-    def activate_transfer(self, vm, ip):
-        self.active_transfers[ip] = vm
+    # Begin transferring data to another VM over connection cid
+    def activate_transfer(self, vm, cid):
+        self.active_transfers[vm] = cid
 
-    # stop transferring data to another VM
-    def deactivate_transfer(self, ip):
-        del self.active_transfers[ip]
-
-    # Callback for whenever a VM transfer completes - should be overridden
-    # kinda janky in that you have to pass 'self' as an argument every time
-    # - don't know if this is an ok way to do callbacks
-    def on_transfer_complete(self, other):
-        pass
+    # stop transferring data to another VM, and return the connection id
+    def deactivate_transfer(self, vm):
+        return self.active_transfers.pop(vm)
 
 class Machine(object):
     NUM_VMs = 4
-    def __init__(self, ID, VMs=None):
+    # If index is given, it is a FreeSlots which is kept up to date as VMs
+    # are added to and removed from this machine. slots overrides NUM_VMs.
+    def __init__(self, ID, VMs=None, index=None, slots=None):
         self.ID = ID
-        self.VMs = VMs or []
+        self.VMs = set(VMs or [])
+        self.index = index
+        if slots is not None:
+            self.NUM_VMs = slots
 
     # Add a VM to the machine and return it, or return False
     def add_vm(self, VM):
         if len(self.VMs) < self.NUM_VMs:
-            self.VMs.append(VM)
+            self.VMs.add(VM)
+            if self.index is not None:
+                self.index.update(self.ID, self.occupancy())
             return VM
         else:
             return False
@@ -83,6 +129,8 @@ class Machine(object):
     def remove_vm(self, VM):
         if VM in self.VMs:
             self.VMs.remove(VM)
+            if self.index is not None:
+                self.index.update(self.ID, self.occupancy())
             return True
         else:
             return False
@@ -90,3 +138,105 @@ class Machine(object):
     # How many open slots does this machine have?
     def occupancy(self):
         return self.NUM_VMs - len(self.VMs)
+
+
+# Index of free VM slots, kept per machine and per group, so that free
+# machines can be found without scanning the whole data center. Machines
+# are numbered group by group, group_size to a group.
+class FreeSlots(object):
+    def __init__(self, num_machines, group_size, slots=Machine.NUM_VMs):
+        self.group_size = group_size
+        self.num_groups = num_machines / group_size
+        self.group_of = [m / group_size for m in xrange(num_machines)]
+
+        # free slots on each machine and in each group
+        self.free = [slots] * num_machines
+        self.group_free = [slots * group_size] * self.num_groups
+
+        # every machine with a free slot, in no particular order, and where
+        # each one sits in that list, so it can be swapped out in O(1)
+        self.open = range(num_machines)
+        self.position = range(num_machines)
+
+        # a min-heap of the open machines in each group. in_heap tracks which
+        # machines have an entry, full ones are dropped when they reach the top
+        self.group_open = [range(g * group_size, (g + 1) * group_size)
+                           for g in xrange(self.num_groups)]
+        self.in_heap = [True] * num_machines
+
+        # a max-heap of (-free slots, group); stale entries are skipped
+        self.most_free = [(-n, g) for g, n in enumerate(self.group_free)]
+        heapq.heapify(self.most_free)
+
+        # every change bumps version and logs the machine that changed. The
+        # log only goes back to version log_start.
+        self.version = 0
+        self.log = []
+        self.log_start = 0
+
+    # Machine m now has n free slots
+    def update(self, m, n):
+        old = self.free[m]
+        if n == old:
+            return
+
+        g = self.group_of[m]
+        self.free[m] = n
+        self.group_free[g] += n - old
+
+        if old == 0:  # it just opened up
+            self.position[m] = len(self.open)
+            self.open.append(m)
+            if not self.in_heap[m]:
+                heapq.heappush(self.group_open[g], m)
+                self.in_heap[m] = True
+        elif n == 0:  # it just filled up
+            last = self.open.pop()
+            if last != m:
+                i = self.position[m]
+                self.open[i] = last
+                self.position[last] = i
+
+        heapq.heappush(self.most_free, (-self.group_free[g], g))
+        if len(self.most_free) > 4 * self.num_groups:
+            self.most_free = [(-n, g) for g, n in enumerate(self.group_free)]
+            heapq.heapify(self.most_free)
+
+        self.version += 1
+        self.log.append(m)
+        if len(self.log) > 4 * len(self.free):
+            drop = len(self.log) / 2
+            del self.log[:drop]
+            self.log_start += drop
+
+    # Return (version, free slots per machine, free slots per group). If
+    # since is an earlier version, the middle part is a dict of only the
+    # machines which changed after it; otherwise it is a tuple of every
+    # machine. If the log doesn't go back that far, everything is returned.
+    def snapshot(self, since=None):
+        if since is None or since < self.log_start:
+            machines = tuple(self.free)
+        else:
+            machines = {m: self.free[m]
+                        for m in self.log[since - self.log_start:]}
+        return self.version, machines, tuple(self.group_free)
+
+    # A random machine with a free slot, or None if everything is full
+    def random_machine(self):
+        if not self.open:
+            return None
+        return random.choice(self.open)
+
+    # The lowest-numbered machine in group g with a free slot, or None
+    def first_in_group(self, g):
+        heap = self.group_open[g]
+        while heap and self.free[heap[0]] == 0:
+            self.in_heap[heapq.heappop(heap)] = False
+        return heap[0] if heap else None
+
+    # The group with the most free slots
+    def emptiest_group(self):
+        heap = self.most_free
+        while -heap[0][0] != self.group_free[heap[0][1]]:
+            heapq.heappop(heap)
+        return heap[0][1]
@@ -0,0 +1,149 @@
+import time, bisect
+
+# Counts where the simulator spends its time. Nothing is counted until a
+# Metrics is attached to a data center, and then only until it is detached:
+#
+#   m = Metrics(dc)
+#   ... run things ...
+#   print m.prometheus()
+#   m.detach()
+#
+# While no Metrics is attached, all the data center pays for this is a check
+# that dc.metrics is None in a few places.
+#
+# The counters are:
+#   updates: calls to _update(), whether or not they moved anything
+#   advances: times the data center was brought forward to a new time
+#   event_loop_iterations: completion instants handled while doing that
+#   roll_forward_visits: connections brought up to date by _roll_forward()
+#   link_speed_lookups: calls to _get_link_speed()
+#   links_added, links_removed: connections started and stopped
+#   callbacks: events delivered to subscribers (which is how
+#       on_transfer_complete is called) and calls to on_transfer_progress
+#
+# callback_seconds is the wall clock time spent inside those callbacks.
+# There is a histogram of iterations per advance, and one of wall clock
+# latency for each public DataCenter method that has been called.
+
+COUNTERS = ['updates', 'advances', 'event_loop_iterations',
+            'roll_forward_visits', 'link_speed_lookups', 'links_added',
+            'links_removed', 'callbacks']
+
+# bucket bounds, in seconds for latencies and in iterations for advances
+LATENCY_BUCKETS = [float('%se%d' % (m, e)) for e in range(-6, 1)
+                   for m in ('1', '2.5', '5')] + [10.0]  # 1us to 10s
+ITERATION_BUCKETS = [0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+
+# Counts of observations at or below each bound, plus a running sum
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last is above them all
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, x):
+        self.counts[bisect.bisect_left(self.bounds, x)] += 1
+        self.sum += x
+        self.count += 1
+
+    # As a dict with cumulative bucket counts, keyed by upper bound
+    def as_dict(self):
+        buckets, total = [], 0
+        for bound, n in zip(self.bounds + [float('inf')], self.counts):
+            total += n
+            buckets.append((bound, total))
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class Metrics(object):
+    def __init__(self, dc=None):
+        self.dc = None
+        self.reset()
+        if dc is not None:
+            self.attach(dc)
+
+    # Start counting dc, instead of whatever was counted before
+    def attach(self, dc):
+        if self.dc is not None:
+            self.detach()
+        self.dc = dc
+        dc.metrics = self
+
+    def detach(self):
+        if self.dc is not None and self.dc.metrics is self:
+            self.dc.metrics = None
+        self.dc = None
+
+    def reset(self):
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.callback_seconds = 0.0
+        self.iterations = Histogram(ITERATION_BUCKETS)
+        self.latency = {}  # method name: Histogram
+
+    # Called by the data center
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def advanced(self, iterations):
+        self.counts['advances'] += 1
+        self.counts['event_loop_iterations'] += iterations
+        self.iterations.observe(iterations)
+
+    def callback(self, seconds):
+        self.counts['callbacks'] += 1
+        self.callback_seconds += seconds
+
+    def called(self, method, seconds):
+        hist = self.latency.get(method)
+        if hist is None:
+            hist = self.latency[method] = Histogram(LATENCY_BUCKETS)
+        hist.observe(seconds)
+
+    # Everything counted so far, as a dict
+    def as_dict(self):
+        d = dict(self.counts)
+        d['callback_seconds'] = self.callback_seconds
+        d['iterations_per_advance'] = self.iterations.as_dict()
+        d['latency'] = {name: hist.as_dict()
+                        for name, hist in self.latency.iteritems()}
+        return d
+
+    # Everything counted so far, in the Prometheus text format
+    def prometheus(self, prefix='datacenter_'):
+        lines = []
+        for name in COUNTERS:
+            lines.append('# TYPE %s%s_total counter' % (prefix, name))
+            lines.append('%s%s_total %d' % (prefix, name, self.counts[name]))
+        lines.append('# TYPE %scallback_seconds_total counter' % prefix)
+        lines.append('%scallback_seconds_total %r' %
+                     (prefix, self.callback_seconds))
+
+        lines.append('# TYPE %siterations_per_advance histogram' % prefix)
+        lines.extend(_histogram(prefix + 'iterations_per_advance', '',
+                                self.iterations))
+        lines.append('# TYPE %sapi_latency_seconds histogram' % prefix)
+        for name in sorted(self.latency):
+            lines.extend(_histogram(prefix + 'api_latency_seconds',
+                                    'method="%s",' % name, self.latency[name]))
+        return '\n'.join(lines) + '\n'
+
+# The sample lines for one histogram; labels go in front of le
+def _histogram(name, labels, hist):
+    lines = []
+    for bound, n in hist.as_dict()['buckets']:
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, le, n))
+    tag = '{' + labels.rstrip(',') + '}' if labels else ''
+    lines.append('%s_sum%s %r' % (name, tag, hist.sum))
+    lines.append('%s_count%s %d' % (name, tag, hist.count))
+    return lines
+
+# Time a call to f(*args), for the data center's callbacks
+def timed(metrics, f, *args):
+    start = time.time()
+    try:
+        return f(*args)
+    finally:
+        metrics.callback(time.time() - start)
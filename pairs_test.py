@@ -1,4 +1,4 @@
-import random, time, itertools, thread
+import sys, random, time, itertools, thread
 from collections import defaultdict
 from machine import Machine, VirtualMachine
 from datacenter import DataCenter
@@ -19,10 +19,11 @@ class PairwiseServer(Server):
 
         # try all machines in order
         m = 0
-        for v in sorted_vms:
-            # try to place in the first available spot
-            while not self.dc.place(v, m):
-                m = (m + 1) % self.dc.NUM_MACHINES            
+        with self.dc.batch():
+            for v in sorted_vms:
+                # try to place in the first available spot
+                while not self.dc.place(v, m):
+                    m = (m + 1) % self.dc.NUM_MACHINES            
 
         self.dc.draw_status()
         self.finished = False
@@ -34,7 +35,7 @@ class PairwiseServer(Server):
         # We are finished when all of our users' VMs are done
         self.finished = True
         for vm in self.vms:
-            if vm.ip in dc.VMs:
+            if vm.ip in self.dc.VMs:
                 self.finished = False
 
         if self.finished or not self.vms:
@@ -49,30 +50,24 @@ class PairwiseServer(Server):
             return
 
         # find machine
-        self.dc.pause()
-        machines = [m for m in range(DataCenter.NUM_MACHINES) 
-                if self.dc.machine_occupancy(m) >= 2]
-        self.dc.unpause()
+        _, free, _ = self.dc.occupancy()
+        machines = [m for m, n in enumerate(free) if n >= 2]
 
         m = random.choice(machines)
 
-        # remove from old machines
-        if vm1.ip in self.dc.VMs:
-            self.dc.remove(vm1.ip)
-        if vm2.ip in self.dc.VMs:
-            self.dc.remove(vm2.ip)
-
-        # place
-        self.dc.place(vm1, m)
-        self.dc.place(vm2, m)
+        # remove from old machines and place, all at once
+        moves = [('move' if v.ip in self.dc.VMs else 'place', v, m)
+                 for v in (vm1, vm2)]
+        self.dc.apply(moves)
 
 
 if __name__ == '__main__':
     # first, place random users around the network with very large connections
-    dc = DataCenter()
+    dc = DataCenter(virtual='--virtual' in sys.argv)
+    dc.renderer.enabled = '--quiet' not in sys.argv
     fill_datacenter(dc, 20, 10, 10**7)
     dc.draw_status()
-    time.sleep(1)  # Wait one second
+    dc.run_until(dc.now() + 1)  # Wait one second
 
     # initialize everything
     servers = [PairwiseServer(i, 20, dc=dc, max_data=100000) for i in range(10)]
@@ -88,4 +83,4 @@ if __name__ == '__main__':
         for s in servers:
             if not s.finished:
                 s.loop()
-        time.sleep(1)
+        dc.run_until(dc.now() + 1)
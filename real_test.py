@@ -1,4 +1,5 @@
-import random, time, itertools, thread
+import sys, random, time, itertools, heapq
+import numpy as np
 from collections import defaultdict
 from machine import Machine, VirtualMachine
 from datacenter import DataCenter
@@ -9,61 +10,19 @@ class SmartVM(VirtualMachine):
     def __init__(self, user, ID, server):
         super(SmartVM, self).__init__(user, ID)
         self.server = server
-        self._group_scores = {i: 0 for i in range(DataCenter.NUM_GROUPS)}
-        self.group_scores = self._group_scores.copy()
-        self.moved = time.time()
-
-    def sorted_groups(self):
-        if self.group() in self.group_scores:
-            del self.group_scores[self.group()]
-        return sorted(self.group_scores.iteritems(), key=lambda i: -i[1])
+        self.moved = server.dc.now()
 
     def group(self):
         try:
-            return int(self.machine / DataCenter.GROUP_SIZE)
+            return self.server.dc.topology.group_of[self.machine]
         except:
             return None
 
     def did_move(self):
-        self.moved = time.time()
+        self.moved = self.server.dc.now()
 
     def last_moved(self):
-        return time.time() - self.moved
-
-    def start_loop(self):
-        thread.start_new_thread(self.loop, ())
-
-    def loop(self):
-        while True:
-            self.calc_group_scores()
-            time.sleep(1)
-
-    # This calculates which (if any) group the VM should jump to
-    def calc_group_scores(self):
-        self._group_scores = {i: 0 for i in range(DataCenter.NUM_GROUPS)}
-
-        # Loop over all transfers, and sum up the amount to transfer in
-        # each group
-        for vm in self.server.vms:
-            group = vm.group()
-            if not group:
-                continue
-
-            if vm in self.active_transfers.values():
-                self._group_scores[group] += self.transfers[vm]
-
-            if self in vm.active_transfers.values():
-                self._group_scores[group] += vm.transfers[self]
-
-        if self.machine is not None:
-            my_group = self.group()
-
-            # Subtract the amount we will lose by leaving the current group
-            for g in self._group_scores:
-                self._group_scores[g] -= self._group_scores[my_group]
-
-        # cache our results
-        self.group_scores = self._group_scores.copy()
+        return self.server.dc.now() - self.moved
 
     # Get the average throughput from this VM to all groups in the system
     def average_throughput(self):
@@ -93,12 +52,13 @@ class SmartServer(Server):
     def start(self):
         self.vms = [SmartVM(self.user, i, self) for i in range(self.n)]
         self.B = sparse_B(self.vms, self.max_data, 5)
-        self.machines_open = {i: [] for i in range(DataCenter.NUM_GROUPS)}
+        self.machines_open = {i: [] for i in range(self.dc.NUM_GROUPS)}
         self.clusters = defaultdict(Cluster)
 
         for vm in self.vms:
             vm.activate(self.B)
             vm.on_transfer_complete = self.on_complete  # set callback
+            vm.on_transfer_progress = self.on_progress
 
         self.greedy_place()
 
@@ -109,19 +69,20 @@ class SmartServer(Server):
         
         group = max(self.machines_open.items(), key=lambda g: len(g[1]))[0]
 
-        # try all machines in order
+        # try all machines in order, and place everything in one go
+        moves = []
         while vms_to_place:
             v = vms_to_place.pop(0)
-            if self.machines_open[group]:
-                m = self.machines_open[group].pop()
-            else:
+            if not self.machines_open[group]:
                 group = max(self.machines_open.items(),
                             key=lambda g: len(g[1]))[0]
+            m = self.machines_open[group].pop()
 
-            self.dc.place(v, m)
-            
+            moves.append(('place', v, m))
             self.clusters[group].vms.append(v)
-            v.start_loop()
+
+        self.dc.apply(moves)
+        self.score_groups()
 
         self.dc.draw_status()
         self.finished = False
@@ -141,30 +102,178 @@ class SmartServer(Server):
         else:
             self.finished = True
 
+    # Work out how much each of our VMs wants to be in each group, from
+    # scratch. raw[i, g] is how much data the i^th VM in B has left to
+    # exchange with our VMs in group g; only transfers between two placed VMs
+    # count. A VM's score for a group is its raw amount there less the raw
+    # amount in its own group. After this, the data center's callbacks and
+    # our own moves keep raw up to date as it changes, and a heap holds each
+    # VM's best move.
+    def score_groups(self):
+        B = self.B
+        vms = B.vms
+        n = len(vms)
+        G = self.dc.NUM_GROUPS
+        group_of = self.dc.topology.group_of
+
+        # every (row, column) entry of B, and how much of it is left
+        rows = np.repeat(np.arange(n), np.diff(B.indptr))
+        cols = B.indices
+        with self.dc.reading():
+            placed = np.array([vm.handle is not None for vm in vms],
+                              dtype=bool)
+            groups = np.array([group_of[vm.machine] if vm.handle is not None
+                               else -1 for vm in vms], dtype=np.intp)
+            left = np.array([vms[i].transfers.get(vms[j], 0) for i, j in
+                             itertools.izip(rows.tolist(), cols.tolist())],
+                            dtype=float)
+
+        # each transfer counts for both of its ends, in the other end's group
+        left[~(placed[rows] & placed[cols])] = 0
+        self.raw = (np.bincount(rows * G + groups[cols], left,
+                                minlength=n * G) +
+                    np.bincount(cols * G + groups[rows], left,
+                                minlength=n * G)).reshape(n, G)
+
+        # the entries of B, what is left of each as counted in raw, and the
+        # group each VM is counted in (-1 if it isn't placed)
+        self.erow = rows.tolist()
+        self.ecol = cols.tolist()
+        self.entry = {(vms[i], vms[j]): e for e, (i, j) in
+                      enumerate(itertools.izip(self.erow, self.ecol))}
+        self.left = left.tolist()
+        self.where = groups.tolist()
+
+        # the entries each VM is at one end of
+        self.touching = [[] for i in range(n)]
+        for e, (i, j) in enumerate(itertools.izip(self.erow, self.ecol)):
+            self.touching[i].append(e)
+            self.touching[j].append(e)
+
+        # heap of (-score, VM, version) for each VM's best move. An entry is
+        # stale once the VM's version has moved on. dirty VMs need a new one.
+        self.best = [None] * n
+        self.version = [0] * n
+        self.heap = []
+        self.dirty = set(range(n))
+
+    # Add amt to raw for both ends of entry e, if they are both placed
+    def _shift(self, e, amt):
+        i, j = self.erow[e], self.ecol[e]
+        gi, gj = self.where[i], self.where[j]
+        if not amt or gi < 0 or gj < 0:
+            return
+        self.raw[i, gj] += amt
+        self.raw[j, gi] += amt
+        self.dirty.add(i)
+        self.dirty.add(j)
+
+    # u has sent another amt MB to v. The data center calls this for us.
+    def on_progress(self, u, v, amt):
+        e = self.entry.get((u, v))
+        if e is not None:
+            self._shift(e, -amt)
+            self.left[e] -= amt
+
+    # A transfer finished, so whatever is left of it (rounding error, by now)
+    # no longer counts
+    def on_complete(self, vm1, vm2):
+        e = self.entry.get((vm1, vm2))
+        if e is not None:
+            self._shift(e, -self.left[e])
+            self.left[e] = 0.0
+        super(SmartServer, self).on_complete(vm1, vm2)
+
+    # Some of our VMs have just moved: count their transfers again in their
+    # new groups. For everyone else, that moves an amount from one column of
+    # raw to another.
+    def _regroup(self, moved):
+        index = self.B.index
+        entries = set()
+        for vm in moved:
+            entries.update(self.touching[index[vm]])
+
+        for e in entries:
+            self._shift(e, -self.left[e])
+        for vm in moved:
+            i = index[vm]
+            self.where[i] = vm.group() if vm.handle is not None else -1
+            self.dirty.add(i)
+        for e in entries:
+            self._shift(e, self.left[e])
+
+    # Work out a new best move for every VM whose raw amounts have changed
+    # since the last call, and push it on the heap
+    def _refresh(self):
+        for i in self.dirty:
+            self.version[i] += 1
+            g = self.where[i]
+            if g < 0:
+                continue
+
+            row = self.raw[i].copy()
+            own = row[g]
+            row[g] = -np.inf
+            self.best[i] = best = row.argmax()
+            if row[best] > own:
+                heapq.heappush(self.heap,
+                               (own - row[best], i, self.version[i]))
+        self.dirty = set()
+
+        # drop the stale entries every so often
+        if len(self.heap) > 4 * len(self.version):
+            self.heap = [x for x in self.heap if x[2] == self.version[x[1]]]
+            heapq.heapify(self.heap)
+
+    # The VM (by index in B) with the best move into group g, other than the
+    # VM skip, or None if nobody wants to go there
+    def _best_into(self, g, ready, skip):
+        n = len(self.where)
+        where = np.array(self.where, dtype=np.intp)
+        into = self.raw[:, g] - self.raw[np.arange(n), where]
+        into[~ready | (where == g) | (where < 0)] = 0
+        into[skip] = 0
+        j = into.argmax()
+        return j if into[j] > 0 else None
+
     def try_move_vm(self):
-        # find the best VM to move
-        possible_moves = []
-        for v in self.vms:
-            if v.last_moved() > 10:
-                # sorted groups comes with (group, score) tuples
-                moves = v.sorted_groups()
-                for m in moves:
-                    # output is (vm, group, score) tuples
-                    if m[1] > 0:
-                        possible_moves.append((v, m[0], m[1]))
-
-        possible_moves = sorted(possible_moves, key=lambda m: m[2])
-
-        if possible_moves:
-            move = possible_moves.pop()
-            if self.machines_open[move[1]]:
-                self.move_vm(move[0], self.machines_open[move[1]][0])
+        vms = self.B.vms
+        with self.dc.batch():
+            self._refresh()
+            now = self.dc.now()
+
+            # only VMs which are placed and haven't moved for 10 seconds can
+            # go. Take the best of them off the heap, and put back the ones
+            # which aren't ready yet.
+            heap = self.heap
+            waiting = []
+            best = None
+            while heap:
+                _, i, version = heap[0]
+                if version != self.version[i]:
+                    heapq.heappop(heap)
+                elif vms[i].handle is not None and now - vms[i].moved > 10:
+                    best = i
+                    break
+                else:
+                    waiting.append(heapq.heappop(heap))
+            for item in waiting:
+                heapq.heappush(heap, item)
+            if best is None:
+                return
+
+            vm = vms[best]
+            g = self.best[best]
+            if self.machines_open[g]:
+                self.move_vm(vm, self.machines_open[g][0])
             else:
-                # get the VM in the current group with the most favorable move
-                other_move = next((m for m in possible_moves 
-                    if m[1] == move[0].group()), None)
-                if other_move:
-                    self.swap_vms(move[0], other_move[0])
+                # get the VM with the most favorable move into our current
+                # group
+                ready = np.array([v.handle is not None and now - v.moved > 10
+                                  for v in vms], dtype=bool)
+                j = self._best_into(self.where[best], ready, best)
+                if j is not None:
+                    self.swap_vms(vm, vms[j])
 
     # Not implemented for now
     def try_move_cluster(self):
@@ -172,17 +281,15 @@ class SmartServer(Server):
 
     # Move a VM from one place to another
     def move_vm(self, vm, machine):
-        old_group = int(vm.machine / self.dc.GROUP_SIZE)
-        group = int(machine / self.dc.GROUP_SIZE)
+        old_group = self.dc.topology.group_of[vm.machine]
+        group = self.dc.topology.group_of[machine]
 
         print 'User', self.user, 'Move!', old_group, '->', group
 
         self.machines_open[old_group].append(vm.machine)
-        self.dc.remove(vm.ip)
+        self.dc.apply([('move', vm, machine)])
+        self._regroup([vm])
 
-        if not self.dc.place(vm, machine):
-            raise Exception('Something is wrong!')
-        
         self.machines_open[group].remove(machine)
         self.clusters[old_group].vms.remove(vm)
         self.clusters[group].vms.append(vm)
@@ -190,19 +297,15 @@ class SmartServer(Server):
 
     # Swap the positions of two VMs
     def swap_vms(self, vm1, vm2):
-        self.dc.pause()
-
         m1 = vm1.machine
         m2 = vm2.machine
-        g1 = int(m1 / self.dc.GROUP_SIZE)
-        g2 = int(m2 / self.dc.GROUP_SIZE)
+        g1 = self.dc.topology.group_of[m1]
+        g2 = self.dc.topology.group_of[m2]
 
         print 'User', self.user, 'Swap!', g1, '<->', g2
 
-        self.dc.remove(vm1.ip)
-        self.dc.remove(vm2.ip)
-        self.dc.place(vm1, m2)
-        self.dc.place(vm2, m1)
+        self.dc.apply([('swap', vm1, vm2)])
+        self._regroup([vm1, vm2])
 
         self.clusters[g1].vms.remove(vm1)
         self.clusters[g2].vms.remove(vm2)
@@ -212,39 +315,40 @@ class SmartServer(Server):
         vm1.did_move()
         vm2.did_move()
 
-        self.dc.unpause()
-
     # Move every vm in the cluster from one group to another
     def move_cluster(self, cluster, group):
-        self.dc.pause()
-
         self.clusters[cluster.group] = Cluster()
+        self.dc.apply([('move', vm, self.machines_open[group].pop())
+                       for vm in cluster.vms])
+        self._regroup(cluster.vms)
         for vm in cluster.vms:
-            self.dc.remove(vm.ip)
-            self.dc.place(vm, self.machines_open[group].pop())
             vm.did_move()
     
         cluster.group = group
         self.clusters[group] = cluster
-        
-        self.dc.unpause()
 
-    # Find how many slots are open in each group
+    # Find how many slots are open in each group. After the first call, only
+    # the machines which changed since the last one are looked at.
     def gather_data(self):
-        self.dc.pause()
-        self.machines_open = {i: [] for i in range(DataCenter.NUM_GROUPS)}
+        since = getattr(self, 'occupancy_version', None)
+        self.occupancy_version, machines, _ = self.dc.occupancy(since)
 
-        for m in range(self.dc.NUM_MACHINES):
-            group = int(m / self.dc.GROUP_SIZE)
-            for x in range(self.dc.machine_occupancy(m)):
-                self.machines_open[group].append(m)
+        if isinstance(machines, tuple):  # a full snapshot
+            self.machines_open = {i: [] for i in range(self.dc.NUM_GROUPS)}
+            machines = enumerate(machines)
+        else:
+            machines = machines.iteritems()
 
-        self.dc.unpause()
+        for m, free in machines:
+            group = self.dc.topology.group_of[m]
+            slots = [i for i in self.machines_open[group] if i != m]
+            self.machines_open[group] = slots + [m] * free
 
 # Test with 1 user, 100 VMs, and an empty data center. Simulates the first
 # scenario described in the prompt for DP2.
 def simple_test():
-    dc = DataCenter()
+    dc = DataCenter(virtual='--virtual' in sys.argv)
+    dc.renderer.enabled = '--quiet' not in sys.argv
     
     # initialize everything
     server = SmartServer(0, 100, dc=dc, max_data=100000)
@@ -257,16 +361,17 @@ def simple_test():
     while not server.finished:
         dc.draw_status()
         server.loop()
-        time.sleep(1)
+        dc.run_until(dc.now() + 1)
 
 # Test with 10 users, each with 20 VMs, in an already crowded data center.
 # This is the standard benchmark we used to compare this scheme to straw men.
 def general_test():
     # first, place random users around the network with very large connections
-    dc = DataCenter()
+    dc = DataCenter(virtual='--virtual' in sys.argv)
+    dc.renderer.enabled = '--quiet' not in sys.argv
     fill_datacenter(dc, 20, 10, 10**7)
     dc.draw_status()
-    time.sleep(1)  # Wait one second
+    dc.run_until(dc.now() + 1)  # Wait one second
 
     # initialize everything
     servers = [SmartServer(i, 20, dc=dc, max_data=100000) for i in range(10)]
@@ -282,9 +387,9 @@ def general_test():
         for s in servers:
             if not s.finished:
                 s.loop()
-        time.sleep(1)
+        dc.run_until(dc.now() + 1)
 
-    dc.draw_status()
+    dc.draw_status(force=True)
 
 if __name__ == '__main__':
     general_test()
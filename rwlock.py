@@ -0,0 +1,89 @@
+import threading, contextlib
+
+# A reader/writer lock. Any number of threads can hold it for reading at once,
+# or a single thread for writing. A writer waits for the readers to leave, and
+# new readers wait while a writer is waiting, so writers don't starve.
+#
+# Both sides are reentrant: the writer can take the lock again for writing or
+# for reading, and a reader can take it again for reading. A reader can't
+# take it for writing, since two readers doing that would wait on each other
+# forever; that raises an error instead.
+class RWLock(object):
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0  # threads holding the lock for reading
+        self._writer = None  # the thread holding it for writing
+        self._writes = 0  # how many times the writer has taken it
+        self._waiting = 0  # writers waiting for it
+        self._local = threading.local()  # this thread's read depth
+
+    def _reads(self):
+        return getattr(self._local, 'reads', 0)
+
+    # True if this thread holds the lock for reading, and not for writing
+    def read_only(self):
+        return self._reads() > 0 and self._writer is not \
+            threading.current_thread()
+
+    def acquire_read(self):
+        reads = self._reads()
+        if reads or self._writer is threading.current_thread():
+            self._local.reads = reads + 1
+            return
+
+        with self._cond:
+            while self._writer is not None or self._waiting:
+                self._cond.wait()
+            self._readers += 1
+        self._local.reads = 1
+
+    def release_read(self):
+        self._local.reads -= 1
+        if self._local.reads or self._writer is threading.current_thread():
+            return
+
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        if self._writer is me:
+            self._writes += 1
+            return
+        if self._reads():
+            raise Exception('Cannot write while holding a read lock')
+
+        with self._cond:
+            self._waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer = me
+            self._writes = 1
+
+    def release_write(self):
+        self._writes -= 1
+        if self._writes:
+            return
+
+        with self._cond:
+            self._writer = None
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
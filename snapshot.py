@@ -0,0 +1,155 @@
+import json, struct
+import numpy as np
+from machine import VirtualMachine
+from topology import Topology
+from traffic import TrafficMatrix
+
+# Snapshots save a data center to a file and load it back as a new virtual
+# data center, so that many experiments can start from the same background
+# without placing it again each time:
+#
+#   snapshot.save(dc, 'background.snap')
+#   ...
+#   dc, vms = snapshot.load('background.snap')
+#
+# A snapshot covers the topology, the clock, every VM in the network (and the
+# VMs they still have data for) with its machine and the data it has left to
+# send, and the per-user totals. Links and their speeds follow from those and
+# are rebuilt on load.
+#
+# The file is a JSON header followed by raw arrays, each aligned to ALIGN
+# bytes. Loading maps the arrays into memory rather than reading them, so
+# only the parts that are used get read from disk.
+
+MAGIC = 'DCSNAP01'
+ALIGN = 64
+
+# Write a snapshot of dc to path
+def save(dc, path):
+    with dc.reading():
+        # the VMs in the network in handle order, then the ones they send to
+        vms = [v for v in dc._vms if v is not None]
+        index = {v: i for i, v in enumerate(vms)}
+        for v in vms[:]:
+            for target in v.transfers:
+                if target not in index:
+                    index[target] = len(vms)
+                    vms.append(target)
+
+        placed = [v.handle is not None for v in vms]
+        rows = [v.transfers if p else {} for v, p in zip(vms, placed)]
+        users = sorted(dc.users)
+        accts = [dc.users[u] for u in users]
+
+        arrays = {
+            'user': np.array([v.user for v in vms], dtype=np.int64),
+            'id': np.array([v.ID for v in vms], dtype=np.int64),
+            'machine': np.array([v.machine if p else -1
+                                 for v, p in zip(vms, placed)],
+                                dtype=np.int32),
+            'total': np.array([getattr(v, 'total_data', 0) if p else 0
+                               for v, p in zip(vms, placed)], dtype=float),
+            'indptr': np.cumsum([0] + [len(r) for r in rows],
+                                dtype=np.int64),
+            'dst': np.array([index[t] for r in rows for t in r],
+                            dtype=np.int64),
+            'amt': np.array([a for r in rows for a in r.itervalues()],
+                            dtype=float),
+            'acct_user': np.array(users, dtype=np.int64),
+            'acct_done': np.array([a.done for a in accts], dtype=float),
+            'acct_seconds': np.array([a.seconds(dc.time) for a in accts],
+                                     dtype=float),
+            'acct_completed': np.array(
+                [np.nan if a.completed is None else a.completed - dc.start_time
+                 for a in accts], dtype=float),
+        }
+
+        topo = dc.topology
+        header = {
+            'time': dc.time - dc.start_time,
+            'completed': dc.completed,
+            'core_traffic': dc.core_traffic(),
+            'topology': {
+                'machines_per_group': topo.machines_per_group,
+                'groups_per_agg': topo.groups_per_agg,
+                'agg_routers': topo.agg_routers,
+                'slots_per_machine': topo.slots_per_machine,
+                'throughput': topo.throughput,
+                'agg_capacity': topo.agg_capacity,
+                'core_capacity': topo.core_capacity},
+            'arrays': {},
+        }
+
+    # lay the arrays out after the header; the header's size depends on the
+    # offsets, so leave it room to grow
+    offset = 0
+    for name in sorted(arrays):
+        a = arrays[name]
+        header['arrays'][name] = {'dtype': a.dtype.str, 'shape': a.shape,
+                                  'offset': offset}
+        offset += -(-a.nbytes // ALIGN) * ALIGN
+    text = json.dumps(header)
+    start = -(-(len(MAGIC) + 4 + len(text) + 1024) // ALIGN) * ALIGN
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', start) + text)
+        for name in sorted(arrays):
+            f.seek(start + header['arrays'][name]['offset'])
+            f.write(arrays[name].tobytes())
+        f.truncate(start + offset)
+
+# Read the header of the snapshot at path, and map each of its arrays
+def read(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception(path + ' is not a data center snapshot')
+        start, = struct.unpack('<I', f.read(4))
+        header = json.JSONDecoder().raw_decode(f.read(start))[0]
+
+    arrays = {}
+    for name, info in header['arrays'].iteritems():
+        shape = tuple(info['shape'])
+        if shape[0]:
+            arrays[name] = np.memmap(path, dtype=info['dtype'], mode='r',
+                                     offset=start + info['offset'],
+                                     shape=shape)
+        else:
+            arrays[name] = np.zeros(shape, dtype=info['dtype'])
+    return header, arrays
+
+# Load the snapshot at path as a new virtual data center. Returns the data
+# center and the list of VMs, in the order they were saved. Any keyword
+# arguments go to DataCenter.
+def load(path, **kwargs):
+    from datacenter import DataCenter
+
+    header, a = read(path)
+    dc = DataCenter(virtual=True, topology=Topology(**header['topology']),
+                    **kwargs)
+    dc.run_until(header['time'])
+
+    vms = [VirtualMachine(user, ID) for user, ID in
+           zip(a['user'].tolist(), a['id'].tolist())]
+    B = TrafficMatrix(vms, a['indptr'], a['dst'], a['amt'])
+    machines = a['machine'].tolist()
+    with dc.batch():
+        for vm, m, total in zip(vms, machines, a['total'].tolist()):
+            vm.activate(B)
+            vm.total_data = total
+        for vm, m in zip(vms, machines):
+            if m >= 0:
+                dc.place(vm, m)
+
+        # the running totals carry on from where they were
+        dc.completed = header['completed']
+        dc._core_sent += header['core_traffic']
+        for usr, done, seconds, completed in zip(
+                a['acct_user'].tolist(), a['acct_done'].tolist(),
+                a['acct_seconds'].tolist(), a['acct_completed'].tolist()):
+            acct = dc.users[usr]
+            acct.done = done
+            acct.vm_seconds = seconds
+            acct.stamp = dc.time
+            if completed == completed:  # not NaN
+                acct.completed = dc.start_time + completed
+    return dc, vms
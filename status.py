@@ -0,0 +1,95 @@
+import sys, time
+
+# Helper class for text colors
+class bcolors:
+    HEADER = '\033[95m'
+    BLUE = '\033[94m'
+    GREEN = '\033[92m'
+    YELLOW = '\033[93m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+
+# Draws a summary of a data center to the terminal. refresh() only redraws
+# once every interval seconds of wall clock time, however often it is called,
+# so the simulation can call it every step without waiting on the terminal.
+# A snapshot never brings the data center up to date; it shows the state as
+# of its last update, read under the data center's read lock. Set enabled to False to turn drawing off altogether.
+class StatusRenderer(object):
+    def __init__(self, dc, interval=0.5, out=None, enabled=True):
+        self.dc = dc
+        self.interval = interval
+        self.out = out or sys.stdout
+        self.enabled = enabled
+        self.last_draw = None  # wall clock time of the last draw
+
+    # Draw the status if it is time to, or right away if force is set
+    def refresh(self, force=False):
+        if not self.enabled:
+            return False
+
+        now = time.time()
+        if not force and self.last_draw is not None and \
+                now - self.last_draw < self.interval:
+            return False
+
+        self.last_draw = now
+        self.out.write(self.render(self.snapshot()))
+        self.out.flush()
+        return True
+
+    # Gather everything the status shows into a dict
+    def snapshot(self):
+        dc = self.dc
+        slots = dc.topology.slots_per_machine * dc.GROUP_SIZE
+
+        with dc.lock.reading():
+            return {
+                'time': dc.time - dc.start_time,
+                'core': sorted((l, len(c))
+                               for l, c in dc.core_links.iteritems()),
+                'agg': sorted((l, len(c))
+                              for l, c in dc.agg_links.iteritems()),
+                'groups': [slots - n for n in dc.free_slots.group_free],
+                'users': sorted((usr, a.seconds(dc.time), a.vms, a.done,
+                                 a.done + max(a.remaining, 0))
+                                for usr, a in dc.users.items() if usr >= 0),
+            }
+
+    # Turn a snapshot into the text to print, starting with a clear screen
+    def render(self, snap):
+        dc = self.dc
+        yellow = lambda x: bcolors.YELLOW + str(x) + bcolors.ENDC
+        lines = [chr(27) + "[2J"]
+
+        # print the system time
+        lines.append(bcolors.HEADER + 'SYSTEM TIME: ' + bcolors.ENDC +
+                     str(snap['time']) + '\n')
+
+        # print link congestion stats: how many connections are using each?
+        lines.append(bcolors.HEADER + 'LINK CONGESTION:' + bcolors.ENDC)
+        lines.append(bcolors.GREEN + ' * core links: ' + bcolors.ENDC +
+                     '; '.join(str(l) + ': ' + yellow(n)
+                               for l, n in snap['core']))
+        lines.append(bcolors.GREEN + ' * aggregate links:' + bcolors.ENDC)
+        for i in range(dc.AGG_ROUTERS):
+            lines.append('   ' + '; '.join(
+                str(l[0]) + '<->' + str(l[1]) + ': ' + yellow(n)
+                for l, n in snap['agg'] if l[1] == i))
+
+        # print the number of VMs in each group
+        lines.append(bcolors.HEADER + '\nTOTAL VMs BY GROUP:' + bcolors.ENDC)
+        for i in range(dc.AGG_ROUTERS):
+            lines.append('   ' + '  '.join(
+                str(g) + ': ' + yellow(snap['groups'][g])
+                for g in dc.topology.groups_under[i]))
+
+        # print some stats for each user
+        lines.append(bcolors.HEADER + '\nUSER: TIME, VMs, % COMPLETION:' +
+                     bcolors.ENDC)
+        for usr, utime, vms, done, total in snap['users']:
+            pct = int(done / float(total) * 100) if total else 100
+            lines.append('   ID ' + str(usr) + ': ' + yellow(
+                str(utime) + ', ' + str(vms) + ', ' + str(int(done)) + '/' +
+                str(int(total)) + ' MB = ' + str(pct) + '%'))
+
+        return '\n'.join(lines) + '\n'
@@ -1,4 +1,4 @@
-import random, time, itertools, thread
+import sys, random, time, itertools, thread
 from collections import defaultdict
 from machine import Machine, VirtualMachine
 from datacenter import DataCenter
@@ -14,19 +14,12 @@ class StragglerServer(Server):
         self.B = sparse_B(self.vms, self.max_data, 5)
         self.finished = False
 
-        # Store initial amount of data to transfer for convenience
-        self.starting_progress = {}
-        for i in range(len(self.vms)):
-            for j in range(i+1, len(self.vms)):
-                vm1 = self.vms[i]
-                vm2 = self.vms[j]
-                self.starting_progress[(i, j)] = self.B[vm1][vm2] + self.B[vm2][vm1]
-
         # start by placing all the VMs randomly around the network
-        for vm in self.vms:
-            vm.activate(self.B)
-            vm.on_transfer_complete = self.on_complete  # set callback
-            self.dc.random_place(vm)
+        with self.dc.batch():
+            for vm in self.vms:
+                vm.activate(self.B)
+                vm.on_transfer_complete = self.on_complete  # set callback
+                self.dc.random_place(vm)
         
         self.dc.draw_status()
 
@@ -37,37 +30,18 @@ class StragglerServer(Server):
                 self.finished = False
 
         
-        # Collect progress between all pairs
-        # Find lowest amount of progress
-        min_progress = 150
-        min_progress_pair = ()
-        for i, vm1 in enumerate(self.vms):
-            the_rest = (e for e in enumerate(self.vms) if e[0] > i)
-            for j, vm2 in the_rest:
-                progress = self.dc.progress(vm1, vm2)
-                percent = 0
-
-                # for now assumes that VMs making no progress have finished
-                if self.starting_progress[(i, j)] > 0:
-                    # Progress = amount of data transferred / amount to
-                    # transfer overall
-                    percent = int(100 * (self.starting_progress[(i, j)] -
-                        progress) / self.starting_progress[(i, j)])
-                if percent != 0:
-                    min_progress = min(percent, min_progress)
-                    min_progress_pair = (vm1, vm2)
-
-        # Get the pair making the least amount of progress and randomly
-        # move one of the VMs somewhere else
-        try:
-            vm_to_move = min_progress_pair[random.randint(0, 1)]
-            self.dc.remove(vm_to_move.ip)
-            self.dc.random_place(vm_to_move)
-        except Exception, e: #find out why this is happening
-            pass 
+        # Find the pair whose transfer will take the longest to finish at
+        # its current rate, and randomly move one of the VMs somewhere else
+        slowest = self.dc.slowest_transfers(self.user, 1)
+        if slowest:
+            vm_to_move = slowest[0][random.randint(0, 1)]
+            with self.dc.batch():
+                self.dc.remove(vm_to_move.ip)
+                self.dc.random_place(vm_to_move)
 
 def simple_test():
-    dc = DataCenter()
+    dc = DataCenter(virtual='--virtual' in sys.argv)
+    dc.renderer.enabled = '--quiet' not in sys.argv
     
     # initialize everything
     server = StragglerServer(0, 20, dc=dc, max_data=10000)
@@ -80,11 +54,12 @@ def simple_test():
     while not server.finished:
         dc.draw_status()
         server.loop()
-        time.sleep(1)
+        dc.run_until(dc.now() + 1)
 
 def straggler_test():
     # first, place random users around the network with very large connections
-    dc = DataCenter()
+    dc = DataCenter(virtual='--virtual' in sys.argv)
+    dc.renderer.enabled = '--quiet' not in sys.argv
     fill_datacenter(dc, 20, 10, 10**7)
     dc.draw_status()
 
@@ -102,7 +77,7 @@ def straggler_test():
         for s in servers:
             if not s.finished:
                 s.loop()
-        time.sleep(1)
+        dc.run_until(dc.now() + 1)
 
 if __name__ == '__main__':
     #simple_test()
@@ -0,0 +1,108 @@
+import sys, os, json, itertools, argparse, traceback, multiprocessing
+import benchmark
+
+# Runs benchmark.run() over every combination in a parameter grid, in a pool
+# of processes, on the virtual clock and without any terminal output. The
+# grid is a JSON object of lists, and every key is an argument to run():
+#
+#   {"scheme": ["greedy", "smart"], "seed": [1, 2, 3],
+#    "max_data": [10000, 100000], "users": [10, 20]}
+#
+#   python sweep.py grid.json results.jsonl
+#
+# Each result is written to the output file, one JSON object per line, as
+# soon as it is done. Running the same sweep again skips every configuration
+# which already has a result there, so an interrupted sweep picks up where it
+# left off. Configurations which raised an error are recorded with the error
+# and tried again next time.
+
+# Every combination of the values in grid, as a list of dicts. A value which
+# isn't a list is used as it is in every combination.
+def expand(grid):
+    keys = sorted(grid)
+    choices = [grid[k] if isinstance(grid[k], list) else [grid[k]]
+               for k in keys]
+    return [dict(zip(keys, values))
+            for values in itertools.product(*choices)]
+
+# A string which is the same for equal configurations
+def config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+# Read the configurations which already have a result in path, and cut off
+# any half-written line at the end so new results start on a line of their own
+def finished(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind('\n') + 1
+        if end < len(data):
+            f.seek(end)
+            f.truncate()
+
+    for line in data[:end].splitlines():
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue
+        if 'error' not in result:
+            done.add(config_key(result['config']))
+    return done
+
+# Run one configuration; this happens in a worker process
+def run_config(config):
+    try:
+        result = benchmark.run(**config)
+    except Exception, e:
+        result = {'error': str(e), 'traceback': traceback.format_exc()}
+    result['config'] = config
+    return result
+
+# Run every configuration in grid which doesn't have a result in path yet,
+# appending the results to path as they come in. Returns how many were run.
+def sweep(grid, path, processes=None, progress=False):
+    done = finished(path)
+    todo = [c for c in expand(grid) if config_key(c) not in done]
+    if not todo:
+        return 0
+
+    # a fresh process for every run, so nothing is left over between them
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count(),
+                                maxtasksperchild=1)
+    try:
+        with open(path, 'a') as out:
+            for i, result in enumerate(
+                    pool.imap_unordered(run_config, todo), 1):
+                out.write(json.dumps(result, sort_keys=True) + '\n')
+                out.flush()
+                if progress:
+                    print >> sys.stderr, '%d/%d' % (i, len(todo)), \
+                        config_key(result['config']), \
+                        'error' if 'error' in result else 'ok'
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return len(todo)
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Run benchmark configurations over a parameter grid.')
+    parser.add_argument('grid', help='JSON file with a list of values for '
+                        'each argument to benchmark.run()')
+    parser.add_argument('out', help='JSON lines file to add results to')
+    parser.add_argument('--processes', type=int,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--progress', action='store_true',
+                        help='report each result on stderr')
+    args = parser.parse_args(argv)
+
+    with open(args.grid) as f:
+        grid = json.load(f)
+    sweep(grid, args.out, args.processes, args.progress)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,222 @@
+import numpy as np
+from collections import deque, defaultdict
+
+# Keeps a short history of how fast data has moved over every connection and
+# every link, so that throughput can be averaged over a recent window instead
+# of read off the current rates. Each history is a fixed-size ring buffer, so
+# memory stays bounded however long the simulation runs.
+#
+# Rates only change at a few instants (when connections start, stop or are
+# re-rated), so a history stores the total data sent at each of them and the
+# rate since the last one. The data sent at any time in between is then exact,
+# and an average over a window which started after the last change is just
+# the current rate.
+
+# A set of histories, one per row. Each row keeps its last capacity samples
+# of (time, total MB sent) in a ring buffer, plus its current rate and the
+# time and total of its latest sample.
+class History(object):
+    def __init__(self, rows=0, capacity=64):
+        self.capacity = capacity
+        self.times = np.zeros((rows, capacity))
+        self.sums = np.zeros((rows, capacity))
+        self.head = [0] * rows  # where the next sample goes
+        self.size = [0] * rows  # how many samples are kept
+        self.rate = [0.0] * rows
+        self.stamp = [0.0] * rows
+        self.total = [0.0] * rows
+
+    def __len__(self):
+        return len(self.rate)
+
+    # Add an empty row, and return its index
+    def add_row(self):
+        n = len(self.rate)
+        if n == len(self.times):
+            more = np.zeros((max(n, 16), self.capacity))
+            self.times = np.vstack((self.times, more))
+            self.sums = np.vstack((self.sums, more))
+        for col in (self.head, self.size, self.rate, self.stamp, self.total):
+            col.append(0)
+        return n
+
+    # Start row over at time t, with nothing sent and a rate of 0
+    def reset(self, row, t):
+        self.head[row] = self.size[row] = 0
+        self.rate[row] = 0.0
+        self.stamp[row] = t
+        self.total[row] = 0.0
+        self._push(row, t, 0.0)
+
+    def _push(self, row, t, total):
+        h = self.head[row]
+        self.times[row, h] = t
+        self.sums[row, h] = total
+        self.head[row] = (h + 1) % self.capacity
+        self.size[row] = min(self.size[row] + 1, self.capacity)
+
+    # Change row's rate from time t onwards
+    def set_rate(self, row, rate, t):
+        if t != self.stamp[row]:
+            self.total[row] += self.rate[row] * (t - self.stamp[row])
+            self.stamp[row] = t
+            self._push(row, t, self.total[row])
+        self.rate[row] = rate
+
+    # row's samples, oldest first, as arrays of times and totals
+    def _samples(self, row):
+        size = self.size[row]
+        idx = (self.head[row] - size + np.arange(size)) % self.capacity
+        return self.times[row, idx], self.sums[row, idx]
+
+    # Total MB row had sent at time t, or None if that is older than the
+    # samples that are left
+    def sent(self, row, t):
+        if t >= self.stamp[row]:
+            return self.total[row] + self.rate[row] * (t - self.stamp[row])
+
+        times, sums = self._samples(row)
+        k = np.searchsorted(times, t, side='right') - 1
+        if k < 0:
+            # nothing was sent before the first sample, if it is still here
+            return 0.0 if self.size[row] < self.capacity else None
+        return sums[k] + (sums[k + 1] - sums[k]) * \
+            (t - times[k]) / (times[k + 1] - times[k])
+
+    # Average rate of row over the window seconds up to time t. If the
+    # samples don't go back that far, the average is over what they cover.
+    def average(self, row, t, window):
+        start = t - window
+        if window <= 0 or start >= self.stamp[row]:
+            return self.rate[row]
+
+        before = self.sent(row, start)
+        if before is None:
+            times, sums = self._samples(row)
+            start, before = times[0], sums[0]
+        return (self.sent(row, t) - before) / (t - start)
+
+    # row's rate over the time its samples cover, as (times, rates): the
+    # rate was rates[i] from times[i] until times[i + 1], and is rates[-1] now
+    def history(self, row):
+        times, sums = self._samples(row)
+        rates = np.append(np.diff(sums) / np.diff(times), self.rate[row])
+        return times, rates
+
+
+# The histories for one data center: one row per connection and one per link.
+# A connection's row is kept for horizon seconds after it stops, so it can
+# still be averaged over, and is picked up again if the same pair of VMs
+# start talking within that time. Links are numbered like the topology's
+# groups for the group -> aggregate links, followed by the aggregate routers
+# for the aggregate -> core links.
+class Telemetry(object):
+    def __init__(self, topology, t, capacity=64, horizon=10.0):
+        self.topology = topology
+        self.horizon = horizon
+
+        self.conns = History(0, capacity)
+        self.pairs = {}  # (src, dst): row
+        self.cids = {}  # connection id: row, while it is active
+        self.keys = []  # row: (src, dst)
+        self.on = []  # row: the link rows it goes over
+        self.idle = []  # row: the time it stopped, or None while active
+        self.stopped = deque()  # (time, row) for every stop, in order
+        self.free = []
+
+        self.links = History(0, capacity)
+        for i in xrange(topology.num_groups + topology.agg_routers):
+            self.links.reset(self.links.add_row(), t)
+
+    # The row of a link: a (group, aggregate) pair or an aggregate router
+    def link_row(self, link):
+        if isinstance(link, tuple):
+            return link[0]
+        return self.topology.num_groups + link
+
+    # Connection cid from u in group g1 to v in group g2 has started
+    def start(self, u, v, cid, g1, g2, t):
+        self._reclaim(t)
+        row = self.pairs.get((u, v))
+        if row is None:
+            if self.free:
+                row = self.free.pop()
+            else:
+                row = self.conns.add_row()
+                self.keys.append(None)
+                self.on.append(None)
+                self.idle.append(None)
+            self.conns.reset(row, t)
+            self.pairs[(u, v)] = row
+            self.keys[row] = (u, v)
+
+        links = []
+        if g1 != g2:
+            a1, a2 = self.topology.agg_of[g1], self.topology.agg_of[g2]
+            links = [g1, g2]
+            if a1 != a2:
+                links += [self.link_row(a1), self.link_row(a2)]
+        self.on[row] = links
+        self.idle[row] = None
+        self.cids[cid] = row
+
+    # The connections cids have just been given new rates by engine. The
+    # changes to each link are added up first, so every link is only
+    # touched once.
+    def rates(self, engine, cids, t):
+        conns, rows, on = self.conns, self.cids, self.on
+        current = conns.rate
+        shift = defaultdict(float)
+        for cid in cids:
+            row = rows[cid]
+            rate = float(engine.rate(cid))
+            old = current[row]
+            if rate != old:
+                conns.set_rate(row, rate, t)
+                for l in on[row]:
+                    shift[l] += rate - old
+        self._shift(shift, t)
+
+    # Connection cid has stopped
+    def stop(self, cid, t):
+        row = self.cids.pop(cid)
+        old = self.conns.rate[row]
+        if old:
+            self.conns.set_rate(row, 0.0, t)
+            self._shift(dict.fromkeys(self.on[row], -old), t)
+        self.idle[row] = t
+        self.stopped.append((t, row))
+        self._reclaim(t)
+
+    # Change the rate of each link in shift by the amount given
+    def _shift(self, shift, t):
+        links = self.links
+        for l, delta in shift.iteritems():
+            links.set_rate(l, max(links.rate[l] + delta, 0.0), t)
+
+    # Free the rows of connections which stopped more than horizon ago and
+    # haven't started again
+    def _reclaim(self, t):
+        stopped = self.stopped
+        while stopped and stopped[0][0] + self.horizon < t:
+            when, row = stopped.popleft()
+            if self.idle[row] == when:
+                del self.pairs[self.keys[row]]
+                self.keys[row] = None
+                self.idle[row] = None
+                self.free.append(row)
+
+    # Average MBPS from u to v over the window seconds up to time t
+    def throughput(self, u, v, t, window):
+        row = self.pairs.get((u, v))
+        if row is None:
+            return 0.0
+        return self.conns.average(row, t, window)
+
+    # Average MBPS over link in the window seconds up to time t
+    def link_throughput(self, link, t, window):
+        return self.links.average(self.link_row(link), t, window)
+
+    # The recent rates over link; see History.history
+    def link_history(self, link):
+        return self.links.history(self.link_row(link))
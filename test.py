@@ -1,31 +1,20 @@
-import random, time, itertools, threading
+import os, random, time, itertools, threading
 from collections import defaultdict
 from machine import Machine, VirtualMachine
+from traffic import TrafficMatrix
 from datacenter import DataCenter
+import snapshot
 
-# generate B as a dict of dicts, n x n, with random amounts of data up to 
-# max_data megabytes to transfer. vmids is a list of ID numbers, not an int
-# B is guaranteed to be a full matrix, although it may contain zeroes.
+# generate B as a TrafficMatrix (see traffic.py) over vms, with random amounts
+# of data up to max_data megabytes to transfer between every pair of VMs.
+# vms is a list of VirtualMachines, not an int. It may contain zeroes, which
+# aren't stored.
 def random_B(vms, max_data):
-    return {u: {v: random.randrange(max_data) 
-                    if u is not v else 0 for v in vms} 
-              for u in vms}
+    return TrafficMatrix.uniform(vms, max_data)
 
 # generate a B matrix with at most max_conn connections from any given VM. 
 def sparse_B(vms, max_data, max_conn):
-    B = {}
-    for u in vms:
-        # Randomly choose max_conn VMs from the set to connect to
-        out_connections = random.sample(vms, max_conn)
-        B[u] = {}
-
-        for v in vms:
-            if v is not u and v in out_connections:
-                B[u][v] = random.randrange(max_data) 
-            else:
-                B[u][v] = 0
-
-    return B
+    return TrafficMatrix.sparse(vms, max_data, max_conn)
 
 # Fill the datacenter with random VMs, assigning them negative ids
 def fill_datacenter(dc, num_usr, num_vm, max_data):
@@ -36,10 +25,24 @@ def fill_datacenter(dc, num_usr, num_vm, max_data):
         B = random_B(vms, max_data)
 
         # activate them and add to the network
-        for vm in vms:
-            vm.activate(B)
-            vm.on_transfer_complete = lambda v1, v2: None
-            dc.random_place(vm)
+        with dc.batch():
+            for vm in vms:
+                vm.activate(B)
+                vm.on_transfer_complete = lambda v1, v2: None
+                dc.random_place(vm)
+
+# Fill the datacenter as fill_datacenter does, but only the first time: the
+# result is saved as a snapshot at path (see snapshot.py), and later calls
+# load it from there instead, so every run gets the same background. Returns
+# the data center, which is a new one if the snapshot was loaded. Only works
+# for virtual data centers.
+def warm_datacenter(path, num_usr, num_vm, max_data, **kwargs):
+    if os.path.exists(path):
+        return snapshot.load(path, **kwargs)[0]
+    dc = DataCenter(virtual=True, **kwargs)
+    fill_datacenter(dc, num_usr, num_vm, max_data)
+    snapshot.save(dc, path)
+    return dc
 
 # A class representing the remote API server, which handles placement logic
 class Server(object):
@@ -59,17 +62,18 @@ class Server(object):
         self.B = random_B(self.vms, self.max_data)  
 
         # start by placing all the VMs randomly around the network
-        for vm in self.vms:
-            vm.activate(self.B)
-            vm.on_transfer_complete = self.on_complete  # set callback
-            self.dc.random_place(vm)  # place!
-            self.dc.draw_status()
+        with self.dc.batch():
+            for vm in self.vms:
+                vm.activate(self.B)
+                vm.on_transfer_complete = self.on_complete  # set callback
+                self.dc.random_place(vm)  # place!
+        self.dc.draw_status()
 
     def loop(self):
         # keep updating until everything's finished
         while self.dc.VMs:
             self.dc.draw_status()
-            time.sleep(1)
+            self.dc.run_until(self.dc.now() + 1)
 
     # the callback for when a VM completes its job - remove it if it has no
     # more data to send or receive.
@@ -0,0 +1,180 @@
+import numpy as np
+
+# Throughput models decide how fast each connection goes. Every connection
+# between the same two groups crosses the same links, so a model only has to
+# keep a table, speeds, of the throughput (in MBPS) between every pair of
+# groups. DataCenter takes the model class as an argument, tells it about
+# connections joining and leaving links, and calls update() before re-rating
+# connections.
+#
+# Link capacities come from the data center's Topology: each group uplink
+# carries agg_capacity and each core uplink core_capacity (both 2 * THROUGHPUT
+# by default), and no single connection can go faster than THROUGHPUT.
+# Connections within one group always get THROUGHPUT.
+
+
+# Every connection gets an equal share of its most congested link, whether or
+# not the other connections on that link can use theirs. This is the
+# original model.
+class EqualShare(object):
+    def __init__(self, dc):
+        self.dc = dc
+        self.speeds = [[self._calc_link_speed(g1, g2)
+                        for g2 in xrange(dc.NUM_GROUPS)]
+                       for g1 in xrange(dc.NUM_GROUPS)]
+
+    # This model just counts the connections in the link sets
+    def join(self, g1, g2):
+        pass
+
+    def leave(self, g1, g2):
+        pass
+
+    # Recalculate the speeds between every group that sits under a touched
+    # link and the rest of the data center. Returns the (g1, g2) pairs whose
+    # speed changed.
+    def update(self, touched_agg, touched_core):
+        stale = set(g for g, ag in touched_agg)
+        for ag in touched_core:
+            stale.update(self.dc.topology.groups_under[ag])
+
+        changed = []
+        for g1 in stale:
+            row = self.speeds[g1]
+            for g2 in xrange(self.dc.NUM_GROUPS):
+                tp = self._calc_link_speed(g1, g2)
+                if tp != row[g2]:
+                    row[g2] = self.speeds[g2][g1] = tp
+                    changed += [(g1, g2), (g2, g1)]
+        return changed
+
+    # Work out the throughput between two groups from the links between them.
+    def _calc_link_speed(self, g1, g2):
+        dc = self.dc
+        topo = dc.topology
+        if g1 == g2:
+            return topo.throughput
+
+        # count the connections on the group links between g1 & g2, and the
+        # core links if they are under different aggregate routers
+        agg = max(len(dc.agg_links[topo.agg_link[g1]]),
+                  len(dc.agg_links[topo.agg_link[g2]]), 1)
+        tp = min(topo.throughput, topo.agg_capacity / agg)
+
+        ag1 = topo.agg_of[g1]
+        ag2 = topo.agg_of[g2]
+        if ag1 != ag2:
+            core = max(len(dc.core_links[ag1]), len(dc.core_links[ag2]), 1)
+            tp = min(tp, topo.core_capacity / core)
+        return tp
+
+
+# Max-min fair allocation by progressive filling: every connection speeds up
+# at the same pace until a link fills, the connections on that link are
+# frozen, and the rest carry on with whatever is left. Unlike EqualShare, no
+# bandwidth is left unused on a link whose connections are bottlenecked
+# somewhere else.
+#
+# Connections are counted per group pair as they join and leave, and the
+# allocation is worked out over group pairs all at once with NumPy, only when
+# something has changed since the last update().
+class MaxMinFair(object):
+    def __init__(self, dc):
+        topo = dc.topology
+        G = topo.num_groups
+        self.num_groups = G
+        self.cap = topo.throughput
+        self.agg = topo.agg_array  # aggregate router of each group
+
+        # links are numbered: group uplinks, then core uplinks, then a dummy
+        # link with no limit for connections which don't touch the core
+        self.capacity = np.concatenate([
+            np.repeat(topo.agg_capacity, G),
+            np.repeat(topo.core_capacity, topo.agg_routers), [np.inf]])
+
+        self.counts = np.zeros((G, G), dtype=np.int64)
+        self.speeds = self._equal_share()
+        np.fill_diagonal(self.speeds, self.cap)
+        self.dirty = False
+
+    # A connection from group g1 to a different group g2 started or stopped
+    def join(self, g1, g2):
+        self.counts[g1, g2] += 1
+        self.dirty = True
+
+    def leave(self, g1, g2):
+        self.counts[g1, g2] -= 1
+        self.dirty = True
+
+    # Reallocate if any connection has joined or left, and return the (g1, g2)
+    # pairs whose speed changed
+    def update(self, touched_agg, touched_core):
+        if not self.dirty:
+            return ()
+        self.dirty = False
+
+        speeds = self.allocate()
+        changed = np.argwhere(speeds != self.speeds)
+        self.speeds = speeds
+        return [(g1, g2) for g1, g2 in changed.tolist()]
+
+    # The 4 links (rows) used by each of the group pairs g1 -> g2 (columns)
+    def _links(self, g1, g2):
+        G = self.num_groups
+        dummy = len(self.capacity) - 1
+        a1, a2 = self.agg[g1], self.agg[g2]
+        cross = a1 != a2
+        return np.vstack([g1, g2, np.where(cross, G + a1, dummy),
+                          np.where(cross, G + a2, dummy)])
+
+    # Total of weights over the links of each column in links
+    def _per_link(self, links, weights):
+        L = len(self.capacity)
+        return sum(np.bincount(row, weights=weights, minlength=L)
+                   for row in links)
+
+    # Work out the max-min fair speed table from the connection counts
+    def allocate(self):
+        g1, g2 = np.nonzero(self.counts)
+        n = self.counts[g1, g2].astype(float)
+        links = self._links(g1, g2)
+
+        rate = np.zeros(len(n))
+        frozen = np.zeros(len(n), dtype=bool)
+        left = self.capacity.copy()
+
+        # Every pass raises the unfrozen pairs to the level where the next
+        # link fills up, and freezes the pairs which cross it
+        while not frozen.all():
+            live = ~frozen
+            load = self._per_link(links[:, live], n[live])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                share = np.where(load > 0, left / load, np.inf)
+
+            level = min(share.min(), self.cap)
+            rate[live] = level
+            if level >= self.cap:
+                break
+
+            full = share <= level * (1 + 10 ** -9)
+            hit = live & full[links].any(axis=0)
+            frozen |= hit
+            left -= self._per_link(links[:, hit], n[hit] * level)
+
+        # Pairs with no connections get what a connection would get under an
+        # equal share of their busiest link
+        speeds = self._equal_share()
+        speeds[g1, g2] = rate
+        np.fill_diagonal(speeds, self.cap)
+        return speeds
+
+    # The EqualShare table, worked out for every pair at once
+    def _equal_share(self):
+        G = self.num_groups
+        load = self._per_link(self._links(*np.nonzero(self.counts)),
+                              self.counts[np.nonzero(self.counts)])
+        limit = self.capacity / np.maximum(load, 1)
+
+        g1, g2 = np.indices((G, G))
+        tightest = limit[self._links(g1.ravel(), g2.ravel())].min(axis=0)
+        return np.minimum(tightest, self.cap).reshape(G, G)
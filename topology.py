@@ -0,0 +1,64 @@
+import numpy as np
+
+# The shape of the data center: machines sit in groups behind a group router,
+# groups hang off aggregate routers, and the aggregate routers all meet at the
+# core. Everything is numbered in order, so machines 0..machines_per_group - 1
+# are group 0, groups 0..groups_per_agg - 1 sit under aggregate router 0, and
+# so on.
+#
+# throughput is the most any one connection can get (and what connections
+# within a group always get), in MBPS. agg_capacity and core_capacity are the
+# total each group -> aggregate and aggregate -> core link can carry; they
+# default to twice throughput.
+class Topology(object):
+    def __init__(self, machines_per_group=12, groups_per_agg=6, agg_routers=4,
+                 slots_per_machine=4, throughput=10000.0, agg_capacity=None,
+                 core_capacity=None):
+        self.machines_per_group = machines_per_group
+        self.groups_per_agg = groups_per_agg
+        self.agg_routers = agg_routers
+        self.slots_per_machine = slots_per_machine
+        self.num_groups = groups_per_agg * agg_routers
+        self.num_machines = machines_per_group * self.num_groups
+
+        self.throughput = float(throughput)
+        self.agg_capacity = float(agg_capacity or 2 * throughput)
+        self.core_capacity = float(core_capacity or 2 * throughput)
+
+        # group_of[m] is machine m's group and agg_of[g] is group g's
+        # aggregate router; agg_link[g] is the key of group g's uplink in
+        # DataCenter.agg_links. groups_under[a] lists the groups under a.
+        self.group_of = [m // machines_per_group
+                         for m in xrange(self.num_machines)]
+        self.agg_of = [g // groups_per_agg for g in xrange(self.num_groups)]
+        self.agg_link = [(g, self.agg_of[g]) for g in xrange(self.num_groups)]
+        self.groups_under = [range(a * groups_per_agg, (a + 1) * groups_per_agg)
+                             for a in xrange(agg_routers)]
+        self.machines_in = [range(g * machines_per_group,
+                                  (g + 1) * machines_per_group)
+                            for g in xrange(self.num_groups)]
+
+        # the same lookups as arrays, for vectorized code
+        self.group_array = np.asarray(self.group_of, dtype=np.intp)
+        self.agg_array = np.asarray(self.agg_of, dtype=np.intp)
+
+    # The layout the simulator has always used: 1/4 of the real machine count
+    @classmethod
+    def quarter(cls, **kwargs):
+        return cls(**kwargs)
+
+    # The full-size data center, with 1152 machines
+    @classmethod
+    def full(cls, **kwargs):
+        kwargs.setdefault('machines_per_group', 48)
+        return cls(**kwargs)
+
+    # A full-size pod layout, repeated until there are pods aggregate routers
+    @classmethod
+    def pods(cls, pods, **kwargs):
+        kwargs.setdefault('machines_per_group', 48)
+        return cls(agg_routers=pods, **kwargs)
+
+    def __repr__(self):
+        return 'Topology(%d machines in %d groups under %d aggregate routers)' \
+            % (self.num_machines, self.num_groups, self.agg_routers)
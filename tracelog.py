@@ -0,0 +1,218 @@
+import json, struct
+import numpy as np
+from collections import defaultdict
+from machine import VirtualMachine
+from topology import Topology
+
+# A trace is a record of everything that happened in a data center: VMs being
+# placed and removed, transfers starting, changing speed, stopping and
+# finishing, and the clock moving. TraceRecorder writes one as the data center
+# runs, and TraceReplayer rebuilds the state of the data center at any time
+# from it, without simulating anything.
+#
+#   rec = TraceRecorder(dc, 'run.trace')
+#   ...
+#   rec.close()
+#
+#   replay = TraceReplayer('run.trace')
+#   dc, vms = replay.datacenter(120.0)
+#
+# The file is a short header followed by fixed-size little-endian records of
+# (kind, time, a, b, c). VMs are numbered in the order the trace first sees
+# them. Times are in seconds since the data center started.
+
+MAGIC = 'DCTRACE1'
+RECORD = struct.Struct('<BdIid')
+DTYPE = np.dtype([('kind', 'u1'), ('t', '<f8'), ('a', '<u4'), ('b', '<i4'),
+                  ('c', '<f8')])
+
+# Record kinds, and what a, b and c are for each
+NEW = 0  # VM a belongs to user b, and has ID c
+DATA = 1  # VM a has c MB to send to VM b
+PLACE = 2  # VM a was placed on machine b
+REMOVE = 3  # VM a was removed
+START = 4  # a transfer from VM a to VM b started with c MB left
+RATE = 5  # the transfer from a to b now goes at c MBPS
+STOP = 6  # the transfer from a to b stopped early with c MB left
+END = 7  # the transfer from a to b finished
+ADVANCE = 8  # the clock moved forward to the record's time
+
+
+# Writes a trace of dc to path (or a file object) until close() is called.
+# Records are buffered and written buffer at a time.
+class TraceRecorder(object):
+    def __init__(self, dc, path, buffer=4096):
+        self.dc = dc
+        self.out = open(path, 'wb') if isinstance(path, basestring) else path
+        self.buffer = buffer
+        self.pending = []
+        self.ids = {}  # VM: its number in the trace
+        self.described = set()  # VMs whose transfers have been written
+
+        topo = dc.topology
+        header = json.dumps({'topology': {
+            'machines_per_group': topo.machines_per_group,
+            'groups_per_agg': topo.groups_per_agg,
+            'agg_routers': topo.agg_routers,
+            'slots_per_machine': topo.slots_per_machine,
+            'throughput': topo.throughput,
+            'agg_capacity': topo.agg_capacity,
+            'core_capacity': topo.core_capacity}})
+        self.out.write(MAGIC + struct.pack('<I', len(header)) + header)
+        dc.trace = self
+
+    def _write(self, kind, a=0, b=0, c=0.0):
+        dc = self.dc
+        self.pending.append(RECORD.pack(kind, dc.time - dc.start_time,
+                                        a, b, c))
+        if len(self.pending) >= self.buffer:
+            self.flush()
+
+    # The number of vm in the trace, giving it one if it is new
+    def _id(self, vm):
+        i = self.ids.get(vm)
+        if i is None:
+            i = self.ids[vm] = len(self.ids)
+            self._write(NEW, i, vm.user, vm.ID)
+        return i
+
+    # The first time a VM is placed, its transfers are written down too
+    def place(self, vm, m):
+        i = self._id(vm)
+        if vm not in self.described:
+            self.described.add(vm)
+            for target, amt in vm.transfers.iteritems():
+                self._write(DATA, i, self._id(target), amt)
+        self._write(PLACE, i, m)
+
+    def remove(self, vm):
+        self._write(REMOVE, self._id(vm))
+
+    def start(self, u, v, amt):
+        self._write(START, self._id(u), self._id(v), amt)
+
+    # The connections cids have just been given new rates by engine
+    def rates(self, engine, cids):
+        for cid in cids:
+            u, v = engine.endpoints(cid)
+            self._write(RATE, self._id(u), self._id(v), engine.rate(cid))
+
+    def stop(self, u, v, amt):
+        self._write(STOP, self._id(u), self._id(v), amt)
+
+    def end(self, u, v):
+        self._write(END, self._id(u), self._id(v))
+
+    def advance(self):
+        self._write(ADVANCE)
+
+    def flush(self):
+        self.out.write(''.join(self.pending))
+        self.pending = []
+        self.out.flush()
+
+    # Write out everything and stop recording
+    def close(self):
+        self.flush()
+        self.out.close()
+        if self.dc.trace is self:
+            self.dc.trace = None
+
+
+# The state of a data center at time, as rebuilt from a trace. vms maps each
+# VM's number to its (user, ID), machine maps the placed ones to their
+# machines, transfers maps each VM to a dict of VM number: MB left to send,
+# and rates maps every running transfer (u, v) to its speed in MBPS.
+class TraceState(object):
+    def __init__(self, time, vms, machine, transfers, rates):
+        self.time = time
+        self.vms = vms
+        self.machine = machine
+        self.transfers = transfers
+        self.rates = rates
+
+
+# Reads a trace written by TraceRecorder
+class TraceReplayer(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise Exception(path + ' is not a data center trace')
+
+        start = len(MAGIC) + 4
+        size, = struct.unpack('<I', data[len(MAGIC):start])
+        self.header = json.loads(data[start:start + size])
+        body = data[start + size:]
+        body = body[:len(body) - len(body) % DTYPE.itemsize]
+        self.records = np.frombuffer(body, dtype=DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    # The time of the last record
+    def end_time(self):
+        return self.records['t'][-1] if len(self.records) else 0.0
+
+    # Work out the state of the data center at time t from the records up to
+    # then
+    def state(self, t):
+        n = np.searchsorted(self.records['t'], t, side='right')
+
+        vms = {}
+        machine = {}
+        transfers = defaultdict(dict)
+        conns = {}  # (u, v): [MB left, rate, as of]
+        for kind, when, a, b, c in self.records[:n].tolist():
+            if kind == RATE:
+                conn = conns[(a, b)]
+                conn[0] -= conn[1] * (when - conn[2])
+                conn[1] = c
+                conn[2] = when
+            elif kind == START:
+                conns[(a, b)] = [c, 0.0, when]
+            elif kind == END:
+                del conns[(a, b)]
+                del transfers[a][b]
+            elif kind == STOP:
+                del conns[(a, b)]
+                transfers[a][b] = c
+            elif kind == PLACE:
+                machine[a] = b
+            elif kind == REMOVE:
+                del machine[a]
+            elif kind == DATA:
+                transfers[a][b] = c
+            elif kind == NEW:
+                vms[a] = (b, int(c))
+
+        # bring the running transfers forward to t
+        rates = {}
+        for (a, b), (left, rate, when) in conns.iteritems():
+            transfers[a][b] = max(left - rate * (t - when), 0.0)
+            rates[(a, b)] = rate
+        return TraceState(t, vms, machine, dict(transfers), rates)
+
+    # Build a virtual DataCenter in the state it was in at time t, with new
+    # VMs standing in for the traced ones. Returns the data center and a dict
+    # of VM number: VM. Any keyword arguments go to DataCenter.
+    def datacenter(self, t, **kwargs):
+        from datacenter import DataCenter
+
+        st = self.state(t)
+        dc = DataCenter(virtual=True,
+                        topology=Topology(**self.header['topology']),
+                        **kwargs)
+        dc.run_until(t)
+
+        vms = {i: VirtualMachine(user, ID)
+               for i, (user, ID) in st.vms.iteritems()}
+        B = {vms[i]: {vms[j]: amt for j, amt in
+                      st.transfers.get(i, {}).iteritems()} for i in vms}
+        for vm in vms.itervalues():
+            vm.activate(B)
+
+        with dc.batch():
+            for i, m in sorted(st.machine.iteritems()):
+                dc.place(vms[i], m)
+        return dc, vms
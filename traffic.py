@@ -0,0 +1,125 @@
+import random
+import numpy as np
+
+# A sparse traffic matrix B for one tenant's VMs: B[u][v] is the amount of
+# data (in MB) VM u has to send to VM v. Only the nonzero entries are kept, in
+# compressed rows: the targets of the VM at position i in vms are
+# indices[indptr[i]:indptr[i + 1]] (positions in vms again, in order), and the
+# amounts are the same slice of data.
+#
+# VirtualMachine.activate() takes one of these directly and reads just its own
+# row. The generators below are vectorized, and draw their numbers from a
+# NumPy generator seeded from the random module unless given rng, so seeding
+# random still makes a run repeatable.
+class TrafficMatrix(object):
+    def __init__(self, vms, indptr, indices, data):
+        self.vms = list(vms)
+        self.index = {vm: i for i, vm in enumerate(self.vms)}
+        self.indptr = np.asarray(indptr, dtype=np.intp)
+        self.indices = np.asarray(indices, dtype=np.intp)
+        self.data = np.asarray(data)
+
+    # Build a matrix from parallel arrays of (row, column, amount) positions,
+    # dropping zeros and the diagonal. Later duplicates of a (row, column)
+    # entry are dropped too.
+    @classmethod
+    def from_entries(cls, vms, rows, cols, data):
+        n = len(vms)
+        rows = np.asarray(rows, dtype=np.intp)
+        cols = np.asarray(cols, dtype=np.intp)
+        data = np.asarray(data)
+
+        keep = (rows != cols) & (data > 0)
+        key = rows[keep] * n + cols[keep]
+        key, first = np.unique(key, return_index=True)
+        data = data[keep][first]
+        rows, cols = key // n, key % n
+
+        indptr = np.zeros(n + 1, dtype=np.intp)
+        np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+        return cls(vms, indptr, cols, data)
+
+    # Build a matrix from a dict of dicts, as the old generators made them
+    @classmethod
+    def from_dict(cls, B):
+        vms = list(B)
+        index = {vm: i for i, vm in enumerate(vms)}
+        entries = [(index[u], index[v], amt) for u in vms
+                   for v, amt in B[u].iteritems() if amt > 0]
+        rows, cols, data = zip(*entries) if entries else ((), (), ())
+        return cls.from_entries(vms, rows, cols, data)
+
+    # Every VM sends up to max_data MB to every other VM
+    @classmethod
+    def uniform(cls, vms, max_data, rng=None):
+        rng = rng or _rng()
+        n = len(vms)
+        rows, cols = np.divmod(np.arange(n * n), n)
+        return cls.from_entries(vms, rows, cols,
+                                rng.randint(0, max_data, size=n * n))
+
+    # Every VM sends up to max_data MB to at most max_conn other VMs
+    @classmethod
+    def sparse(cls, vms, max_data, max_conn, rng=None):
+        rng = rng or _rng()
+        rows, cols = _targets(len(vms), max_conn, rng)
+        return cls.from_entries(vms, rows, cols,
+                                rng.randint(0, max_data, size=len(rows)))
+
+    # Like sparse(), but the amounts follow a Pareto distribution with shape
+    # alpha: most transfers are around max_data / 100 MB, and a few are much
+    # bigger, up to max_data.
+    @classmethod
+    def heavy_tailed(cls, vms, max_data, max_conn, alpha=1.2, rng=None):
+        rng = rng or _rng()
+        rows, cols = _targets(len(vms), max_conn, rng)
+        amts = (rng.pareto(alpha, size=len(rows)) + 1) * (max_data / 100.0)
+        return cls.from_entries(vms, rows, cols, np.minimum(amts, max_data))
+
+    def __len__(self):
+        return len(self.vms)
+
+    def __iter__(self):
+        return iter(self.vms)
+
+    def __contains__(self, vm):
+        return vm in self.index
+
+    # B[u][v] still works, though row() and amount() are cheaper
+    def __getitem__(self, u):
+        row = dict.fromkeys(self.vms, 0)
+        row.update(self.row(u))
+        return row
+
+    # The nonzero entries of u's row, as a dict of VM: amount
+    def row(self, u):
+        i = self.index[u]
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        vms = self.vms
+        return {vms[j]: amt for j, amt in
+                zip(self.indices[lo:hi].tolist(), self.data[lo:hi].tolist())}
+
+    # How much data u has to send to v
+    def amount(self, u, v):
+        i, j = self.index[u], self.index[v]
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        k = lo + np.searchsorted(self.indices[lo:hi], j)
+        if k < hi and self.indices[k] == j:
+            return self.data[k].item()
+        return 0
+
+    # The number of nonzero entries
+    def nnz(self):
+        return len(self.data)
+
+
+# A NumPy generator seeded from the random module
+def _rng():
+    return np.random.RandomState(random.getrandbits(32))
+
+# Up to max_conn random targets for each of n rows, as (rows, cols). Targets
+# are drawn with replacement, so repeats and the row itself are dropped later.
+def _targets(n, max_conn, rng):
+    rows = np.repeat(np.arange(n), max_conn)
+    cols = rng.randint(0, n, size=n * max_conn)
+    return rows, cols